@@ -1,16 +1,187 @@
-import os, io, hashlib, pickle, faiss, numpy as np
-from sentence_transformers import SentenceTransformer
+import os, io, re, json, time, bisect, heapq, atexit, shutil, hashlib, pickle, threading
+import faiss, numpy as np
+from collections import Counter, OrderedDict
+from itertools import count, groupby, repeat
+from contextlib import contextmanager
 
 PDF_DIR = "./docs"
-PAGE_FILE = "./page.file"
+PAGE_FILE = "./pagefile"  # directory, see "Pagefile layout" below
+LEGACY_PAGE_FILE = "./page.file"  # old single-pickle format
+PAGEFILE_VERSION = 2  # 1: a single segment, before segmented pagefiles
+KEEP_SNAPSHOTS = int(os.getenv("RAG_KEEP_SNAPSHOTS", "3"))  # kept for rollback
+X_MODE = os.getenv("RAG_X_MODE", "mmap")  # mmap: vectors.f32 | index: from the index
+EMB_CACHE = "./emb.cache"  # chunk-text hash -> vector, survives rebuilds
+EMB_CACHE_MAX = 500_000  # above this, entries no longer in the corpus are dropped
+QUERY_CACHE = "./query.cache"  # normalized question -> vector (LRU)
+QUERY_CACHE_MAX = 4096
+ANSWER_CACHE = "./answer.cache"  # (query vector, retrieved chunk ids) -> LLM answer
+ANSWER_CACHE_SIM = float(os.getenv("RAG_ANSWER_SIM", "0.95"))  # min cosine to reuse
+ANSWER_CACHE_TTL = float(os.getenv("RAG_ANSWER_TTL", str(7 * 24 * 3600)))  # seconds
+ANSWER_CACHE_MAX = 2048
+CONTEXT_TOKENS = int(os.getenv("RAG_CONTEXT_TOKENS", "1500"))  # packed context ceiling
+MMR_LAMBDA = 0.7  # context packing: relevance vs novelty
+DUP_SIM = 0.95  # cosine at which a chunk counts as a duplicate of one already packed
+MODEL_NAME = "all-MiniLM-L6-v2"
+EMBED_BACKEND = os.getenv("RAG_EMBED", "torch")  # torch | onnx (int8) | hash (offline)
+EMBED_THREADS = int(os.getenv("RAG_EMBED_THREADS", "0"))  # 0 = library default
+ONNX_FILE = os.getenv("RAG_ONNX_FILE", "onnx/model_quint8_avx2.onnx")  # int8 export
+HASH_DIM = 384  # hash backend: same width as MiniLM
 CHUNK_WORDS = 220  # ≈ short paragraph (150–220 works well)
+CHUNKER = os.getenv("RAG_CHUNKER", "tokens")  # tokens (word-pieces) | words
+CHUNK_TOKENS = int(os.getenv("RAG_CHUNK_TOKENS", "256"))  # capped at max_seq_length
+CHUNK_OVERLAP = int(os.getenv("RAG_CHUNK_OVERLAP", "32"))  # word-pieces shared
+ENCODE_BATCH = int(os.getenv("RAG_ENCODE_BATCH", "64"))  # sentences per forward pass
+ENCODE_WORKERS = int(os.getenv("RAG_ENCODE_WORKERS", "0"))  # 0/1 = encode in-process
 TOPK = 8  # sensible default (5–8)
+EXTRACT_WORKERS = int(os.getenv("RAG_EXTRACT_WORKERS", "0"))  # 0/1 = one worker
+EXTRACT_TIMEOUT = float(os.getenv("RAG_EXTRACT_TIMEOUT", "300"))  # s per PDF, 0 = none
+PAGES_PER_TASK = 40  # large PDFs are fanned out in page ranges of this size
+BUILD_BATCH = int(os.getenv("RAG_BUILD_BATCH", "1024"))  # chunks per build step
+BUILD_MEM_MB = int(os.getenv("RAG_BUILD_MEM_MB", "256"))  # chunk text per build step
+TRAIN_MAX = 65_536  # ivf/pq/sq8 train on a strided sample of at most this many rows
+INDEX_KIND = os.getenv("RAG_INDEX", "flat")  # flat (exact) | ivf | hnsw | sq8 | ivfpq
+IVF_NPROBE = int(os.getenv("RAG_NPROBE", "8"))  # lists scanned per query (ivf)
+HNSW_EF_SEARCH = int(os.getenv("RAG_EF_SEARCH", "64"))  # candidates per query (hnsw)
+HNSW_M = 32  # graph degree (hnsw)
+IVF_MIN_TRAIN = 40  # training vectors per IVF list; too few for 2+ lists → flat
+RETRAIN_GROWTH = 2.0  # retrain ivf once the corpus supports this many times its nlist
+PQ_MIN_TRAIN = 10_000  # ~39 points per PQ centroid; below this ivfpq → sq8
+RERANK_FACTOR = int(os.getenv("RAG_RERANK", "4"))  # candidates per hit (sq8/pq)
+LEXICAL = os.getenv("RAG_LEXICAL", "off")  # off | auto | filter | fuse
+LEX_CANDIDATES = 256  # BM25 rows whose vectors are scored in filter mode
+LEX_RARE = 0.02  # auto: filter when a query term occurs in at most this share of chunks
+BM25_K1, BM25_B = 1.2, 0.75
+RRF_K = 60  # reciprocal rank fusion constant (fuse mode)
+FILTER_SCAN_MAX = 50_000  # filtered subsets up to this many chunks are scanned exactly
 
-model = SentenceTransformer("all-MiniLM-L6-v2")
+# The embedding model and the OpenAI client are created on first use, so retrieval,
+# manifest checks and the page table never pay for torch/openai they don't need.
+# rag.model and rag.client still work (module __getattr__). The model comes from
+# the RAG_EMBED backend; every backend offers the slice of the SentenceTransformer
+# API used here (encode, tokenizer, max_seq_length, get_sentence_embedding_dimension).
+_lazy = {}
+_lazy_lock = threading.Lock()
 
 
+def _torch_model():
+    from sentence_transformers import SentenceTransformer
+
+    if EMBED_THREADS:
+        import torch
+
+        torch.set_num_threads(EMBED_THREADS)
+    return SentenceTransformer(MODEL_NAME)
+
+
+def _onnx_model():  # ONNX Runtime on CPU; ONNX_FILE picks the (quantized) export
+    import onnxruntime as ort
+    from sentence_transformers import SentenceTransformer
+
+    opts = ort.SessionOptions()
+    if EMBED_THREADS:
+        opts.intra_op_num_threads = EMBED_THREADS
+    kw = {
+        "file_name": ONNX_FILE,
+        "provider": "CPUExecutionProvider",
+        "session_options": opts,
+    }
+    return SentenceTransformer(MODEL_NAME, backend="onnx", model_kwargs=kw)
+
+
+class HashEncoding(dict):  # the part of a BatchEncoding that chunk_tokens reads
+    def __init__(self, spans, special):
+        super().__init__(
+            input_ids=list(range(len(spans) + 2 * special)), offset_mapping=spans
+        )
+
+    def word_ids(self):
+        return list(range(len(self["offset_mapping"])))
+
+
+class HashTokenizer:  # one token per word or punctuation mark
+    def __call__(
+        self, text, add_special_tokens=True, return_offsets_mapping=False, verbose=True
+    ):
+        if not isinstance(text, str):
+            return {
+                "input_ids": [self(t, add_special_tokens)["input_ids"] for t in text]
+            }
+        return HashEncoding(
+            [m.span() for m in re.finditer(r"\w+|[^\w\s]", text)], add_special_tokens
+        )
+
+
+class HashEmbedder:  # deterministic, offline: signed hashing of word uni/bigrams
+    max_seq_length = 256
+
+    def __init__(self, dim=HASH_DIM):
+        self.dim, self.tokenizer = dim, HashTokenizer()
+
+    def get_sentence_embedding_dimension(self):
+        return self.dim
+
+    def encode(self, texts, batch_size=None, convert_to_numpy=True):
+        out = np.zeros((len(texts), self.dim), np.float32)
+        for r, t in enumerate(texts):
+            w = tokenize(t)[: self.max_seq_length - 2]
+            for f in w + [a + " " + b for a, b in zip(w, w[1:])]:
+                h = int.from_bytes(
+                    hashlib.blake2b(f.encode("utf-8"), digest_size=8).digest(), "little"
+                )
+                out[r, h % self.dim] += 1.0 if h >> 63 else -1.0
+        return out / np.maximum(np.linalg.norm(out, axis=1, keepdims=True), 1e-12)
+
+
+EMBED_BACKENDS = {"torch": _torch_model, "onnx": _onnx_model, "hash": HashEmbedder}
+
+
+def encoder_tag(backend=None):  # stored with every vector; tags never mix
+    backend = backend or EMBED_BACKEND
+    if backend == "hash":
+        return f"hash:{HASH_DIM}"
+    if backend == "onnx":
+        return f"onnx:{MODEL_NAME}:{ONNX_FILE}"
+    return f"torch:{MODEL_NAME}"
+
+
+def get_model():
+    if "model" not in _lazy:
+        with _lazy_lock:
+            if "model" not in _lazy:
+                if EMBED_BACKEND not in EMBED_BACKENDS:
+                    known = " | ".join(EMBED_BACKENDS)
+                    raise ValueError(
+                        f"RAG_EMBED: unknown backend {EMBED_BACKEND!r} ({known})"
+                    )
+                _lazy["model"] = EMBED_BACKENDS[EMBED_BACKEND]()
+    return _lazy["model"]
+
+
+def get_client():
+    if "client" not in _lazy:
+        with _lazy_lock:
+            if "client" not in _lazy:
+                from openai import OpenAI
+
+                _lazy["client"] = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    return _lazy["client"]
+
+
+def __getattr__(name):
+    if name == "model":
+        return get_model()
+    if name == "client":
+        return get_client()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+import multiprocessing as mp
 from pathlib import Path
-from PyPDF2 import PdfReader
+
+# A PDF is known by two fingerprints: file_sig (stat only, free) and content_hash
+# (its bytes), which is computed only when file_sig changes. Equal content keeps
+# the document's chunk ids, so a touch, checkout or copy to another host re-reads
+# the bytes once and a rename re-keys the manifest; neither re-extracts anything.
 
 
 def file_sig(path):
@@ -21,18 +192,139 @@ def file_sig(path):
     return h.hexdigest()
 
 
-def load_texts_with_meta(pdf_path):  # -> list[(text, meta)] where meta has doc/page
-    out = []
+def content_hash(path):  # blake2b-128 (stdlib; about as fast as disk reads)
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def diff_manifest(old, pdfs):  # -> kept entries, {path: sig} to chunk, retired paths
+    sigs = {str(p): file_sig(p) for p in pdfs}
+    hashes = {}
+    for p, s in sigs.items():
+        e = old.get(p)
+        hashes[p] = (
+            e["hash"] if e and e["sig"] == s and "hash" in e else content_hash(p)
+        )
+    manifest, carried = {}, set()
+    for p, e in old.items():
+        if p not in sigs:
+            continue
+        # unchanged or touched; a PDF that failed to read is retried on a new sig
+        if e["sig"] == sigs[p] or ("failed" not in e and e.get("hash") == hashes[p]):
+            manifest[p] = {**e, "sig": sigs[p], "hash": hashes[p]}
+            carried.add(p)
+    moved = {
+        e["hash"]: p
+        for p, e in old.items()
+        if p not in carried and "hash" in e and "failed" not in e
+    }
+    todo = {}
+    for p in sigs:
+        if p in manifest:
+            continue
+        src = moved.pop(hashes[p], None)
+        if src is None:
+            todo[p] = {"sig": sigs[p], "hash": hashes[p]}
+        else:  # renamed: same bytes under a new path
+            manifest[p] = {**old[src], "sig": sigs[p], "hash": hashes[p]}
+            carried.add(src)
+    return manifest, todo, [p for p in old if p not in carried]
+
+
+def read_pages(pdf_path, start=0, stop=None):  # -> page count, pages [start, stop)
+    n, out = 0, []
+    from PyPDF2 import PdfReader
+
     p = Path(pdf_path)
     try:
         reader = PdfReader(str(p))
-        for i, pg in enumerate(reader.pages, start=1):
-            t = pg.extract_text() or ""
+        n = len(reader.pages)
+        for i in range(start, n if stop is None else min(stop, n)):
+            t = reader.pages[i].extract_text() or ""
             if t.strip():
-                out.append((t, {"doc": p.name, "page": i}))
+                out.append((t, {"doc": p.name, "page": i + 1}))
     except Exception as e:
         print(f"warn: failed to read {p}: {e}")
-    return out
+    return n, out
+
+
+def extract_pages(pdf_path, start=0, stop=None):  # pages [start, stop), 0-based
+    return read_pages(pdf_path, start, stop)[1]
+
+
+def load_texts_with_meta(pdf_path):  # -> list[(text, meta)] where meta has doc/page
+    return extract_pages(pdf_path)
+
+
+# Extraction runs in a process pool, also when serial (a one-process pool), so a PDF
+# that hangs PyPDF2 can be given up on after `timeout` seconds: the pool is then
+# terminated, which kills the stuck worker, and the rest go to a fresh one. Workers
+# are spawned, not forked, so they never inherit the locks of a serving, watching
+# process. Each PDF's first task reads its first PAGES_PER_TASK pages and its page
+# count, so small PDFs are parsed once; the rest of a large PDF fans out in page
+# ranges. Results are collected in submission order, so doc/page order matches
+# serial. RAG_EXTRACT_TIMEOUT=0 reads serially in-process, without a limit.
+
+
+def read_group(pool, group, timeout):  # -> [(path, pages)], path that timed out
+    heads = [pool.apply_async(read_pages, (p, 0, PAGES_PER_TASK)) for p in group]
+    tasks = []
+    for p, h in zip(group, heads):
+        try:
+            n, first = h.get(timeout)
+        except mp.TimeoutError:
+            return [], p
+        spans = range(PAGES_PER_TASK, n, PAGES_PER_TASK)
+        jobs = [
+            pool.apply_async(extract_pages, (p, s, s + PAGES_PER_TASK)) for s in spans
+        ]
+        tasks.append((p, first, jobs))
+    done = []
+    for p, first, jobs in tasks:
+        deadline = time.monotonic() + timeout
+        try:
+            parts = [j.get(max(0.0, deadline - time.monotonic())) for j in jobs]
+        except mp.TimeoutError:
+            return done, p
+        done.append((p, first + [x for part in parts for x in part]))
+    return done, None
+
+
+# yields (path, pages); pages is None for a PDF that timed out
+def iter_texts_by_file(pdfs, workers=EXTRACT_WORKERS, timeout=EXTRACT_TIMEOUT):
+    pdfs = [str(p) for p in pdfs]
+    if not timeout:
+        for p in pdfs:
+            yield p, load_texts_with_meta(p)
+        return
+    if not pdfs:
+        return
+    workers, ctx = max(workers, 1), mp.get_context("spawn")
+    step = 2 * workers  # PDFs in flight, so extracted text held at once stays bounded
+    pending = pdfs[::-1]
+    pool = ctx.Pool(workers)
+    try:
+        while pending:
+            group = [pending.pop() for _ in range(min(step, len(pending)))]
+            done, stuck = read_group(pool, group, timeout)
+            yield from done
+            if stuck is None:
+                continue
+            print(f"warn: timed out reading {stuck} after {timeout:.0f}s, skipping it")
+            yield stuck, None
+            pool.terminate()  # kills the stuck worker
+            pool = ctx.Pool(workers)
+            seen = {stuck, *(p for p, _ in done)}
+            pending.extend(reversed([p for p in group if p not in seen]))
+    finally:
+        pool.terminate()
+
+
+def load_texts_by_file(pdfs, workers=EXTRACT_WORKERS, timeout=EXTRACT_TIMEOUT):
+    return [pages for _, pages in iter_texts_by_file(pdfs, workers, timeout)]
 
 
 def chunk_text(text, n=CHUNK_WORDS):
@@ -40,110 +332,2167 @@ def chunk_text(text, n=CHUNK_WORDS):
     return [" ".join(w[i : i + n]) for i in range(0, len(w), n)]
 
 
-def build_chunks(pdf_dir):
+# Token chunking: all-MiniLM-L6-v2 embeds at most 256 word-pieces (incl. [CLS] and
+# [SEP]) and silently drops the rest, which a 220-word chunk often exceeds. Chunks
+# are cut at word boundaries so each fits the model window, neighbours sharing
+# CHUNK_OVERLAP word-pieces.
+
+
+def chunk_limit():  # word-pieces per chunk, excluding the two special tokens
+    return min(CHUNK_TOKENS, get_model().max_seq_length) - 2
+
+
+def chunk_tokens(text, n=None, overlap=CHUNK_OVERLAP):
+    n = n or chunk_limit()
+    enc = get_model().tokenizer(
+        text, add_special_tokens=False, return_offsets_mapping=True, verbose=False
+    )
+    offs, words = enc["offset_mapping"], enc.word_ids()
+    out, s = [], 0
+    while s < len(offs):
+        e = min(s + n, len(offs))
+        if e < len(offs):  # back off to a word start, unless one word fills the window
+            e = next((b for b in range(e, s, -1) if words[b] != words[b - 1]), e)
+        out.append(" ".join(text[offs[s][0] : offs[e - 1][1]].split()))
+        if e == len(offs):
+            break
+        s = max(s + 1, e - overlap)
+        while s < e and words[s] == words[s - 1]:
+            s += 1
+    return [c for c in out if c]
+
+
+def chunk_pages(pages):  # list[(text, meta)] -> chunks, metas
     chunks, metas = [], []
-    for pdf in Path(pdf_dir).glob("*.pdf"):
-        for t, meta in load_texts_with_meta(pdf):
-            cs = chunk_text(t)
-            chunks.extend(cs)
-            metas.extend([{**meta, "chunk": j + 1} for j in range(len(cs))])
+    split = chunk_tokens if CHUNKER == "tokens" else chunk_text
+    for t, meta in pages:
+        cs = split(t)
+        chunks.extend(cs)
+        metas.extend([{**meta, "chunk": j + 1} for j in range(len(cs))])
     return chunks, metas
 
 
-def encode(arr):
-    return np.asarray(model.encode(arr, convert_to_numpy=True), dtype="float32")
+# Chunk ids are rows in chunks/metas/X and the ids stored in the index. Rows are
+# append-only; each manifest entry lists its document's [start, stop) id ranges
+# and, per page with text, [page, text hash, start, stop]. When a PDF changes,
+# pages whose extracted text (and number) are unchanged keep their ids; only the
+# others are chunked and encoded again.
+
 
+def page_hash(text):
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=8).hexdigest()
 
-def build_index(chunks):
-    X = encode(chunks)
-    ix = faiss.IndexFlatL2(X.shape[1])  # squared L2 distance
-    ix.add(X)
-    return ix, X
 
+# prev: the document's old page entries; its unchanged pages keep their ids
+def chunk_doc(pages, start=0, prev=None):  # -> chunks, metas, page entries
+    old = {(pg, h): (a, b) for pg, h, a, b in prev or ()}
+    chunks, metas, entries = [], [], []
+    for t, meta in pages:
+        h = page_hash(t)
+        if (meta["page"], h) in old:
+            entries.append([meta["page"], h, *old[meta["page"], h]])
+            continue
+        cs, ms = chunk_pages([(t, meta)])
+        a = start + len(chunks)
+        chunks.extend(cs)
+        metas.extend(ms)
+        entries.append([meta["page"], h, a, a + len(cs)])
+    return chunks, metas, entries
 
-def save_pagefile(ix, X, chunks, metas, manifest, path=PAGE_FILE):
-    with open(path, "wb") as f:
-        pickle.dump(
-            {"ix": ix, "X": X, "chunks": chunks, "metas": metas, "manifest": manifest},
-            f,
+
+def page_ranges(entries):  # page entries -> id ranges, each in page order
+    out = []  # [start, stop, last page]
+    for pg, _, a, b in sorted(entries, key=lambda e: e[2]):
+        if b <= a:
+            continue
+        if out and out[-1][1] == a and out[-1][2] < pg:
+            out[-1][1:] = [b, pg]
+        else:
+            out.append([a, b, pg])
+    return [[a, b] for a, b, _ in out]
+
+
+# returns chunks, metas and {path: page entries}
+def chunk_files(pdfs, workers=EXTRACT_WORKERS, start=0, prev=None):
+    pdfs, prev = [str(p) for p in pdfs], prev or {}
+    chunks, metas, pages = [], [], {}
+    for p, texts in iter_texts_by_file(pdfs, workers):
+        if texts is None:  # timed out: left out of pages; the caller marks it failed
+            continue
+        cs, ms, pages[p] = chunk_doc(texts, start + len(chunks), prev.get(p))
+        chunks.extend(cs)
+        metas.extend(ms)
+    return chunks, metas, pages
+
+
+def range_ids(ranges):
+    return np.concatenate(
+        [np.arange(a, b, dtype=np.int64) for a, b in ranges] or [np.zeros(0, np.int64)]
+    )
+
+
+def build_chunks(pdf_dir, workers=EXTRACT_WORKERS):
+    return chunk_files(Path(pdf_dir).glob("*.pdf"), workers)[:2]
+
+
+def iter_chunk_batches(
+    pdfs, pages, workers=EXTRACT_WORKERS, batch=BUILD_BATCH, mem_mb=BUILD_MEM_MB
+):
+    # -> (chunks, metas) of at most batch chunks / mem_mb of text; fills pages per PDF
+    cs_buf, ms_buf, size, n = [], [], 0, 0
+    for p, texts in iter_texts_by_file(pdfs, workers):
+        if texts is None:  # timed out
+            continue
+        cs, ms, pages[p] = chunk_doc(texts, n)
+        n += len(cs)
+        for c, m in zip(cs, ms):
+            cs_buf.append(c)
+            ms_buf.append(m)
+            size += len(c)
+            if len(cs_buf) >= batch or size >= mem_mb << 20:
+                yield cs_buf, ms_buf
+                cs_buf, ms_buf, size = [], [], 0
+    if cs_buf:
+        yield cs_buf, ms_buf
+
+
+def encode(arr):  # longest first, so each batch pads to similar lengths
+    arr = list(arr)
+    order = np.argsort([-len(t) for t in arr], kind="stable")
+    V = get_model().encode(
+        [arr[i] for i in order], batch_size=ENCODE_BATCH, convert_to_numpy=True
+    )
+    out = np.empty_like(np.asarray(V, dtype="float32"))
+    out[order] = V
+    return out
+
+
+# Multi-process encoding for builds and updates: texts are cut into contiguous
+# shards, one per worker process (each loads its own model, spawned rather than
+# forked so no torch threads are inherited), and the shards' vectors are stacked
+# back in order. Calls too small to shard run in-process until the pool exists.
+
+
+def _init_encoder(backend, threads):
+    global EMBED_BACKEND, EMBED_THREADS
+    EMBED_BACKEND, EMBED_THREADS = backend, threads
+    get_model()
+
+
+class EncoderPool:  # drop-in for encode(); the pool starts on the first shardable call
+    def __init__(self, workers=ENCODE_WORKERS):
+        self.workers, self.pool = workers, None
+
+    def __call__(self, texts):
+        texts = list(texts)
+        n = max(ENCODE_BATCH, -(-len(texts) // max(self.workers, 1)))  # shard size
+        if self.pool is None and (self.workers <= 1 or len(texts) <= n):
+            return encode(texts)
+        if self.pool is None:
+            threads = EMBED_THREADS or max(1, (os.cpu_count() or 1) // self.workers)
+            self.pool = mp.get_context("spawn").Pool(
+                self.workers, _init_encoder, (EMBED_BACKEND, threads)
+            )
+        return np.vstack(
+            self.pool.map(encode, [texts[i : i + n] for i in range(0, len(texts), n)])
         )
 
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
 
-def load_pagefile(path=PAGE_FILE):
-    with open(path, "rb") as f:
-        return pickle.load(f)
+    def __enter__(self):
+        return self
 
+    def __exit__(self, *exc):
+        self.close()
 
-# Build fresh (first run)
 
+def text_key(text):
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
 
-def build_pagefile(pdf_dir=PDF_DIR, path=PAGE_FILE):
-    chunks, metas = build_chunks(pdf_dir)
-    ix, X = build_index(chunks)
-    manifest = {str(p): file_sig(p) for p in Path(pdf_dir).glob("*.pdf")}
-    save_pagefile(ix, X, chunks, metas, manifest, path)
-    return ix, X, chunks, metas, manifest
 
+# The embedding cache is an append-only directory store: keys-G.bin (16-byte text
+# keys) and vectors-G.f32 (float32 rows in the same order), valid up to the row
+# count in meta.json. Rows are saved as they are encoded: their keys and vectors
+# are appended and meta.json replaced, so an update writes only its new vectors
+# and a build holds no more than one batch of them; a save cut short leaves rows
+# past the count, which the next one truncates. Vectors are read through a
+# read-only map and keys looked up by binary search in a sorted copy of the key
+# column (24 bytes a row), with keys saved since it was sorted kept in a dict
+# until they are a quarter of it. Pruning writes the kept rows under generation
+# G + 1, which meta.json switches to in one step.
 
-# Update (incremental add/modify). If deletions detected → rebuild for simplicity.
 
+class EmbeddingCache:  # content-addressed: only never-seen chunk texts hit the model
+    # encoder: e.g. an EncoderPool
+    def __init__(self, path=EMB_CACHE, model_name=None, encoder=None):
+        self.path, self.model_name, self.encoder = (
+            path,
+            model_name or encoder_tag(),
+            encoder or encode,
+        )
+        self.gen, self.n, self.X = 0, 0, None  # saved rows, mapped
+        self.index = np.zeros(0, "S16"), np.zeros(0, np.int64)  # sorted keys, rows
+        self.recent = {}  # key -> row, not in index yet
+        self.P, self.p, self.K = None, 0, []  # unsaved rows and their keys
+        self.rewrite = False  # next save starts a new generation
+        try:
+            if path and os.path.isfile(path):  # pickled cache from an older version
+                with open(path, "rb") as f:
+                    d = pickle.load(f)
+                self.rewrite = True
+                if d["model"] == self.model_name and len(d["keys"]):
+                    self.recent = {k: i for i, k in enumerate(d["keys"])}
+                    self.P, self.p = np.asarray(d["X"], np.float32), len(d["keys"])
+                    self.K = list(d["keys"])
+            elif path and os.path.isdir(path):
+                meta = read_meta(path)
+                self.gen = meta["gen"]
+                if meta["model"] != self.model_name:
+                    self.rewrite = True
+                else:
+                    self._map(meta["rows"], meta["dim"])
+                    self._sort()
+        except Exception as e:
+            print(f"warn: ignoring unreadable embedding cache {path}: {e}")
+            self.n, self.X, self.P, self.p, self.K = 0, None, None, 0, []
+            self.index, self.recent = (np.zeros(0, "S16"), np.zeros(0, np.int64)), {}
+            self.rewrite = True
 
-def update_pagefile(pdf_dir=PDF_DIR, path=PAGE_FILE):
-    if not os.path.exists(path):
-        return build_pagefile(pdf_dir, path)
+    def __len__(self):
+        return self.n + self.p
+
+    def _file(self, name, ext, gen=None):
+        return os.path.join(
+            self.path, f"{name}-{self.gen if gen is None else gen}.{ext}"
+        )
+
+    def _keys(self):  # saved key column, mapped
+        if not self.n:
+            return np.zeros(0, "S16")
+        return np.memmap(self._file("keys", "bin"), "S16", "r", shape=(self.n,))
+
+    def _map(self, n, d):
+        self.n = n
+        self.X = (
+            np.memmap(self._file("vectors", "f32"), np.float32, "r", shape=(n, d))
+            if n
+            else None
+        )
+
+    def _sort(self):  # fold recent into index
+        keys = self._keys()
+        order = np.argsort(keys, kind="stable")
+        self.index, self.recent = (np.asarray(keys[order]), order), {}
+
+    def find(self, keys):  # -> cache row per key, -1 if not cached
+        rows = np.array([self.recent.get(k, -1) for k in keys], np.int64)
+        sk, sr = self.index
+        if len(sk) and len(keys):
+            q = np.frombuffer(b"".join(keys), "S16")
+            pos = np.minimum(np.searchsorted(sk, q), len(sk) - 1)
+            hit = (rows < 0) & (sk[pos] == q)
+            rows[hit] = sr[pos[hit]]
+        return rows
+
+    def encode(self, texts):
+        keys = [text_key(t) for t in texts]
+        rows = self.find(keys)
+        todo = {}
+        for k, t, r in zip(keys, texts, rows.tolist()):
+            if r < 0 and k not in todo:
+                todo[k] = t
+        if todo:
+            V = self.encoder(list(todo.values()))
+            self._reserve(self.p + len(V), V.shape[1])
+            self.P[self.p : self.p + len(V)] = V
+            new = {k: len(self) + i for i, k in enumerate(todo)}
+            self.recent.update(new)
+            self.p += len(V)
+            self.K.extend(todo)
+            rows = np.array([new.get(k, r) for k, r in zip(keys, rows.tolist())])
+            if self.path:
+                self.save()
+        if not keys:
+            return np.zeros(
+                (0, get_model().get_sentence_embedding_dimension()), "float32"
+            )
+        return self.vectors(rows)
+
+    def vectors(self, rows):  # cache rows -> float32 vectors
+        d = self.X.shape[1] if self.X is not None else self.P.shape[1]
+        out = np.empty((len(rows), d), np.float32)
+        saved = rows < self.n
+        if saved.any():
+            out[saved] = self.X[rows[saved]]
+        if not saved.all():
+            out[~saved] = self.P[rows[~saved] - self.n]
+        return out
+
+    def _reserve(self, n, d):  # capacity doubles, so batch-by-batch encodes stay linear
+        if self.P is None or n > len(self.P):
+            P = np.empty((max(n, 2 * self.p), d), np.float32)
+            P[: self.p] = self.P[: self.p] if self.P is not None else 0
+            self.P = P
+
+    def save(self, live=None):  # live: chunk texts still in the corpus
+        if not self.path:
+            return
+        if live is not None and len(self) > EMB_CACHE_MAX:
+            rows = self.find([text_key(t) for t in live])
+            keep = np.unique(rows[rows >= 0])
+            if len(keep) < len(self):
+                return self._write(keep)
+        if self.rewrite:
+            return self._write(np.arange(len(self), dtype=np.int64))
+        if not self.p:
+            return
+        self._dir()
+        d = self.P.shape[1]
+        for name, ext, data, size in (
+            ("keys", "bin", b"".join(self.K), 16 * self.n),
+            ("vectors", "f32", self.P[: self.p].tobytes(), 4 * d * self.n),
+        ):
+            with open(self._file(name, ext), "ab") as f:
+                f.truncate(size)  # drop the tail of a save that died midway
+                f.write(data)
+        self._commit(self.gen, len(self), d)
+        if len(self.recent) > max(4096, len(self.index[0]) // 4):
+            self._sort()
+
+    def _dir(self):  # a pickled cache file from an older version is replaced
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+        os.makedirs(self.path, exist_ok=True)
+
+    def _write(self, rows):  # the given rows, renumbered, as a new generation
+        self._dir()
+        gen, d = self.gen + 1, 0
+        saved = rows[rows < self.n]
+        with open(self._file("keys", "bin", gen), "wb") as f:
+            f.write(self._keys()[saved].tobytes())
+            f.write(b"".join(self.K[r - self.n] for r in rows[len(saved) :].tolist()))
+        with open(self._file("vectors", "f32", gen), "wb") as f:
+            for s in range(0, len(rows), BUILD_BATCH):
+                V = self.vectors(rows[s : s + BUILD_BATCH])
+                f.write(V.tobytes())
+                d = V.shape[1]
+        self._commit(gen, len(rows), d)
+        self._sort()
+
+    def _commit(self, gen, n, d):  # replace meta.json, then map the saved rows
+        meta = {"model": self.model_name, "gen": gen, "rows": n, "dim": d}
+        tmp = os.path.join(self.path, "meta.json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp, os.path.join(self.path, "meta.json"))
+        old, self.gen, self.rewrite = self.gen, gen, False
+        self.P, self.p, self.K = None, 0, []
+        if gen != old:
+            for name, ext in (("keys", "bin"), ("vectors", "f32")):
+                if os.path.exists(self._file(name, ext, old)):
+                    os.remove(self._file(name, ext, old))
+        self._map(n, d)
+
+
+def normalize_query(q):  # the MiniLM tokenizer is uncased, so this keeps the vector
+    return " ".join(q.lower().split())
+
+
+class QueryCache:  # LRU of normalized question -> vector; repeats skip the model
+    def __init__(self, path=QUERY_CACHE, max_size=QUERY_CACHE_MAX, model_name=None):
+        self.path, self.max_size, self.model_name = (
+            path,
+            max_size,
+            model_name or encoder_tag(),
+        )
+        self.items, self.hits, self.misses, self.dirty = OrderedDict(), 0, 0, False
+        self.lock = threading.Lock()
+        if path and os.path.exists(path):
+            try:
+                with open(path, "rb") as f:
+                    d = pickle.load(f)
+                if d["model"] == self.model_name:
+                    self.items = OrderedDict(d["items"])
+                    self.hits, self.misses = d["hits"], d["misses"]
+            except Exception as e:
+                print(f"warn: ignoring unreadable query cache {path}: {e}")
+
+    def encode(self, queries):
+        keys = [normalize_query(q) for q in queries]
+        with self.lock:
+            found = {k: self.items[k] for k in keys if k in self.items}
+            self.hits += sum(k in found for k in keys)
+            self.misses += sum(k not in found for k in keys)
+        todo = list(dict.fromkeys(k for k in keys if k not in found))
+        if todo:
+            found.update(zip(todo, encode(todo)))
+        with self.lock:
+            for k in keys:
+                self.items[k] = found[k]
+                self.items.move_to_end(k)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+            self.dirty = True
+        return np.asarray([found[k] for k in keys], dtype=np.float32)
+
+    def stats(self):
+        n = self.hits + self.misses
+        return {
+            "size": len(self.items),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / n if n else 0.0,
+        }
+
+    def save(self):
+        with self.lock:
+            if not self.dirty or not self.path:
+                return
+            d = {
+                "model": self.model_name,
+                "items": list(self.items.items()),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+            self.dirty = False
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(d, f)
+        os.replace(tmp, self.path)
+
+
+def get_query_cache():  # saved at exit
+    if "qcache" not in _lazy:
+        with _lazy_lock:
+            if "qcache" not in _lazy:
+                _lazy["qcache"] = QueryCache()
+                atexit.register(_lazy["qcache"].save)
+    return _lazy["qcache"]
+
+
+def encode_queries(queries):
+    return get_query_cache().encode(list(queries))
+
+
+# Index kinds. Every kind searches by chunk id: flat, hnsw and sq8 through
+# IndexIDMap2, ivf/ivfpq natively (with a hashtable direct map so rows can be
+# reconstructed/removed). ivf falls back to flat and ivfpq to sq8 until there
+# are enough vectors to train them; hnsw cannot remove ids, so deletions rebuild
+# its graph from the stored vectors. The compressed kinds (sq8: 4x, ivfpq: 16x
+# smaller codes) always keep vectors.f32 and re-rank their top candidates with
+# exact distances (RerankIndex).
+
+COMPRESSED = ("sq8", "ivfpq")
+
+
+def ivf_nlist(n):
+    return max(1, min(int(4 * np.sqrt(n)), n // IVF_MIN_TRAIN))
+
+
+def pq_m(d):  # sub-quantizers: d/4 one-byte codes, i.e. 16x smaller than float32
+    return max(m for m in range(1, d // 4 + 1) if d % m == 0)
+
+
+def planned_kind(n, kind=None):  # what make_index builds for n vectors
+    kind = kind or INDEX_KIND
+    if kind == "ivf" and ivf_nlist(n) < 2:
+        return "flat"
+    if kind == "ivfpq" and n < PQ_MIN_TRAIN:
+        return "sq8"
+    return kind
+
+
+def _inner(ix):
+    return faiss.downcast_index(ix.index) if hasattr(ix, "id_map") else ix
+
+
+def index_kind(ix):
+    inner = _inner(ix)
+    for attr, kind in (
+        ("pq", "ivfpq"),
+        ("sq", "sq8"),
+        ("nlist", "ivf"),
+        ("hnsw", "hnsw"),
+    ):
+        if hasattr(inner, attr):
+            return kind
+    return "flat"
+
+
+def vector_bytes(ix):  # code bytes per stored vector (excluding ids and graph links)
+    inner = _inner(ix)
+    inner = faiss.downcast_index(inner.storage) if hasattr(inner, "storage") else inner
+    return int(getattr(inner, "code_size", 4 * ix.d))
+
+
+def tune_index(ix, nprobe=None, ef_search=None):  # search-time knobs, not persisted
+    if hasattr(ix, "nprobe"):
+        ix.nprobe = nprobe or IVF_NPROBE
+    inner = _inner(ix)
+    if hasattr(inner, "hnsw"):
+        inner.hnsw.efSearch = ef_search or HNSW_EF_SEARCH
+    return ix
+
+
+def index_ids(ix):  # ids currently stored in an index
+    if hasattr(ix, "id_map"):
+        return faiss.vector_to_array(ix.id_map)
+    if hasattr(ix, "invlists"):
+        ls = ix.invlists
+        parts = [
+            faiss.rev_swig_ptr(ls.get_ids(j), ls.list_size(j)).copy()
+            for j in range(ix.nlist)
+        ]
+        return np.concatenate(parts) if parts else np.zeros(0, np.int64)
+    return np.arange(ix.ntotal, dtype=np.int64)
+
+
+def train_sample(X):  # X may be a memmap of the whole corpus
+    n = len(X)
+    return (
+        X
+        if n <= TRAIN_MAX
+        else np.asarray(X[np.linspace(0, n - 1, TRAIN_MAX).astype(np.int64)])
+    )
+
+
+def make_index(X, ids, kind=None, batch=None):  # batch: add rows in slices of this size
+    (n, d), kind = X.shape, planned_kind(len(X), kind)
+    if kind in ("ivf", "ivfpq"):
+        q = faiss.IndexFlatL2(d)
+        if kind == "ivf":
+            ix = faiss.IndexIVFFlat(q, d, ivf_nlist(n))
+        else:
+            ix = faiss.IndexIVFPQ(q, d, ivf_nlist(n), pq_m(d), 8)
+        ix.train(train_sample(X))
+        ix.set_direct_map_type(faiss.DirectMap.Hashtable)
+    elif kind == "hnsw":
+        ix = faiss.IndexIDMap2(faiss.IndexHNSWFlat(d, HNSW_M))
+    elif kind == "sq8":
+        ix = faiss.IndexIDMap2(
+            faiss.IndexScalarQuantizer(d, faiss.ScalarQuantizer.QT_8bit)
+        )
+        if n:
+            ix.train(train_sample(X))
+    else:
+        ix = faiss.IndexIDMap2(faiss.IndexFlatL2(d))  # squared L2 distance
+    ids, step = np.asarray(ids, dtype=np.int64), batch or max(n, 1)
+    for s in range(0, n, step):
+        ix.add_with_ids(
+            np.ascontiguousarray(X[s : s + step], dtype=np.float32), ids[s : s + step]
+        )
+    return tune_index(ix)
+
+
+def needs_rebuild(ix, n, kind=None):  # n = live vectors after the pending update
+    have = index_kind(ix)
+    if have != planned_kind(n, kind):
+        return True
+    return have in ("ivf", "ivfpq") and ivf_nlist(n) >= RETRAIN_GROWTH * ix.nlist
+
+
+class RerankIndex:  # compressed index whose top candidates are re-scored exactly from X
+    def __init__(self, ix, X, factor=RERANK_FACTOR):
+        self.ix, self.X, self.factor = ix, X, factor
+
+    def __getattr__(self, name):  # ntotal, d, add_with_ids, remove_ids, ...
+        return getattr(self.ix, name)
+
+    def search(self, Q, k, params=None):
+        Q = np.asarray(Q, dtype=np.float32)
+        kw = {} if params is None else {"params": params}
+        _, C = self.ix.search(Q, k * self.factor, **kw)
+        D = np.full((len(Q), k), np.inf, dtype=np.float32)
+        labels = np.full((len(Q), k), -1, dtype=np.int64)
+        for r, (q, ids) in enumerate(zip(Q, C)):
+            ids = ids[ids >= 0]
+            if len(ids):
+                d = ((live_vectors(self.X, ids) - q) ** 2).sum(1)
+                o = np.argsort(d, kind="stable")[:k]
+                D[r, : len(o)], labels[r, : len(o)] = d[o], ids[o]
+        return D, labels
+
+
+# Lexical prefilter: a BM25 inverted index over the chunk texts, stored in the
+# pagefile next to the vectors and updated with the same append/retire steps.
+# Queries carrying a rare term (a regulation number, a company name) are answered
+# by scoring only the vectors of the best BM25 rows instead of the whole index.
+
+TOKEN_RE = re.compile(r"\w+(?:[.\-/]\w+)*")  # keeps "164.502", "ISO/IEC", "covid-19"
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower())
+
+
+class Lexicon:  # sorted terms -> (ids, tfs) postings; added rows stay in memory
+    # until spill() writes them out as one more sorted run; save() merges the runs.
+    def __init__(self, terms=(), offs=None, ids=None, tfs=None, lens=None):
+        offs = np.zeros(1, np.int64) if offs is None else offs
+        ids = np.zeros(0, np.int64) if ids is None else ids
+        tfs = np.zeros(0, np.int32) if tfs is None else tfs
+        # (id offset, sorted terms, CSR postings); terms: TextStore on disk
+        self.runs = [(0, terms, offs, ids, tfs)]
+        # tokens per row, 0 = retired
+        self.lens = np.array([] if lens is None else lens, dtype=np.int32)
+        self.tail, self._stats = {}, None  # term -> [(id, tf)]
+
+    @classmethod
+    def build(cls, chunks):
+        lex = cls()
+        lex.add(0, chunks)
+        return lex
+
+    @classmethod
+    def merge(cls, lexes, starts):  # one view over the lexicons of consecutive segments
+        lex = cls(
+            lens=np.concatenate([x.lens for x in lexes] or [np.zeros(0, np.int32)])
+        )
+        lex.runs = [(s + r[0],) + r[1:] for x, s in zip(lexes, starts) for r in x.runs]
+        for x, s in zip(lexes, starts):
+            for term, rows in x.tail.items():
+                lex.tail.setdefault(term, []).extend((i + s, tf) for i, tf in rows)
+        return lex
+
+    def __len__(self):
+        return len(self.lens)
+
+    def add(self, start, texts):  # rows start, start + 1, ...
+        if start != len(self.lens):
+            raise ValueError(
+                f"lexicon has {len(self.lens)} rows, cannot add at {start}"
+            )
+        lens = []
+        for i, t in enumerate(texts, start):
+            toks = tokenize(t)
+            lens.append(len(toks))
+            for term, tf in Counter(toks).items():
+                self.tail.setdefault(term, []).append((i, tf))
+        self.lens = np.concatenate([self.lens, np.asarray(lens, np.int32)])
+        self._stats = None
+
+    def retire(self, ids):
+        self.lens[np.asarray(ids, dtype=np.int64)] = 0
+        self._stats = None
+
+    def _tail_run(self):  # the in-memory postings as a run (CSR arrays)
+        terms = sorted(self.tail)
+        offs = np.cumsum([0] + [len(self.tail[t]) for t in terms], dtype=np.int64)
+        rows = [row for t in terms for row in self.tail[t]]
+        rows = np.asarray(rows, dtype=np.int64).reshape(-1, 2)
+        return (0, terms, offs, rows[:, 0].copy(), rows[:, 1].astype(np.int32))
+
+    def spill(self, stem):  # tail -> sorted run in stem.*, mapped back read-only
+        if not self.tail:
+            return
+        _, terms, offs, ids, tfs = self._tail_run()
+        _write_texts(stem + ".terms", terms)
+        offs.tofile(stem + ".off")
+        ids.tofile(stem + ".ids")
+        tfs.tofile(stem + ".tf")
+        self.runs.append(
+            (
+                0,
+                _map_texts(stem + ".terms", len(terms)),
+                _mmap(stem + ".off", np.int64, (len(terms) + 1,)),
+                _mmap(stem + ".ids", np.int64, (len(ids),)),
+                _mmap(stem + ".tf", np.int32, (len(ids),)),
+            )
+        )
+        self.tail = {}
+
+    def postings(self, term):  # -> ids, tfs of live rows containing term
+        ids, tfs = [np.zeros(0, np.int64)], [np.zeros(0, np.int32)]
+        for start, terms, offs, rids, rtfs in self.runs:
+            j = bisect.bisect_left(terms, term)
+            if j < len(terms) and terms[j] == term:
+                a, b = offs[j], offs[j + 1]
+                ids.append(np.asarray(rids[a:b]) + start)
+                tfs.append(np.asarray(rtfs[a:b]))
+        if term in self.tail:
+            t = np.asarray(self.tail[term], dtype=np.int64)
+            ids.append(t[:, 0])
+            tfs.append(t[:, 1])
+        ids, tfs = np.concatenate(ids), np.concatenate(tfs)
+        keep = self.lens[ids] > 0
+        return ids[keep], tfs[keep]
+
+    def stats(self):  # live rows, mean row length
+        if self._stats is None:
+            n = int(np.count_nonzero(self.lens))
+            self._stats = (n, float(self.lens.sum()) / n if n else 1.0)
+        return self._stats
+
+    def search(self, text, n):  # -> ids, scores of the n best rows, min df of the terms
+        N, avgdl = self.stats()
+        parts, scores, df = [], [], 0
+        for term in set(tokenize(text)):
+            ids, tfs = self.postings(term)
+            if not len(ids):
+                continue
+            df = min(df or len(ids), len(ids))
+            idf = np.log(1 + (N - len(ids) + 0.5) / (len(ids) + 0.5))
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lens[ids] / avgdl)
+            parts.append(ids)
+            scores.append(idf * tfs * (BM25_K1 + 1) / (tfs + norm))
+        if not parts:
+            return np.zeros(0, np.int64), np.zeros(0), 0
+        u, inv = np.unique(np.concatenate(parts), return_inverse=True)
+        sc = np.bincount(inv, weights=np.concatenate(scores))
+        top = np.argsort(-sc, kind="stable")[:n]
+        return u[top], sc[top], df
+
+    def rows(self, text, max_df):  # live rows holding a query term of df <= max_df
+        parts = [
+            ids
+            for ids, _ in map(self.postings, set(tokenize(text)))
+            if 0 < len(ids) <= max_df
+        ]
+        return np.unique(np.concatenate(parts)) if parts else np.zeros(0, np.int64)
+
+    def merged(self):  # -> (term, ids, tfs) of live rows, k-way merged over the runs
+        runs = self.runs + ([self._tail_run()] if self.tail else [])
+        streams = (zip(run[1], repeat(r), count()) for r, run in enumerate(runs))
+        for term, group in groupby(heapq.merge(*streams), key=lambda e: e[0]):
+            ids, tfs = [], []
+            for _, r, j in group:
+                start, _, offs, rids, rtfs = runs[r]
+                ids.append(np.asarray(rids[offs[j] : offs[j + 1]]) + start)
+                tfs.append(np.asarray(rtfs[offs[j] : offs[j + 1]]))
+            ids, tfs = np.concatenate(ids), np.concatenate(tfs)
+            keep = self.lens[ids] > 0
+            if keep.any():
+                yield term, ids[keep], tfs[keep]
+
+    def save(self, path):  # streams merged() to disk -> sizes for meta.json
+        offs = [0]
+        with open(os.path.join(path, "postings.ids"), "wb") as fi, open(
+            os.path.join(path, "postings.tf"), "wb"
+        ) as ft:
+
+            def terms():  # written term by term, so no postings pile up here
+                for term, ids, tfs in self.merged():
+                    ids.astype(np.int64).tofile(fi)
+                    tfs.astype(np.int32).tofile(ft)
+                    offs.append(offs[-1] + len(ids))
+                    yield term
+
+            n = _write_texts(os.path.join(path, "terms"), terms())
+        np.asarray(offs, dtype=np.int64).tofile(os.path.join(path, "postings.off"))
+        self.lens.tofile(os.path.join(path, "lens.i32"))
+        return {"terms": n, "postings": offs[-1]}
+
+
+def load_lexicon(path, sizes, n):  # sizes: meta.json["lex"]
+    return Lexicon(
+        _map_texts(os.path.join(path, "terms"), sizes["terms"]),
+        _mmap(os.path.join(path, "postings.off"), np.int64, (sizes["terms"] + 1,)),
+        _mmap(os.path.join(path, "postings.ids"), np.int64, (sizes["postings"],)),
+        _mmap(os.path.join(path, "postings.tf"), np.int32, (sizes["postings"],)),
+        _mmap(os.path.join(path, "lens.i32"), np.int32, (n,)),
+    )
+
+
+def ensure_lexicon(pf):  # older pagefiles get a lexicon built from their chunks
+    if pf.get("lex") is None:
+        lex = Lexicon.build(pf["chunks"])
+        if has_ids(pf["manifest"]):
+            lex.retire(np.setdiff1d(np.arange(len(lex)), live_ids(pf["manifest"])))
+        pf["lex"] = lex
+    return pf["lex"]
+
+
+class LexicalIndex:  # vector index searched through a Lexicon when given query texts
+    # A query term is rare when it occurs in at most LEX_RARE of the chunks (min. 1).
+    # auto: with a rare term, score only the vectors of the rows holding one (padded
+    # with the best BM25 rows, then the nearest vectors, up to k); else vectors
+    # only. filter: like auto, but without a rare term score the LEX_CANDIDATES
+    # best BM25 rows. fuse: reciprocal rank fusion of the vector and BM25 lists.
+    # off (default): vectors only.
+    def __init__(self, ix, X, lex, mode=None):
+        self.ix, self.X, self.lex, self.mode = ix, X, lex, mode or LEXICAL
+
+    def __getattr__(self, name):
+        return getattr(self.ix, name)
+
+    def _exact(self, q, ids, k=None):  # squared distances; k: the k closest, sorted
+        d = ((live_vectors(self.X, ids) - q) ** 2).sum(1)
+        o = np.arange(len(ids)) if k is None else np.argsort(d, kind="stable")[:k]
+        return d[o], ids[o]
+
+    def search(self, Q, k, params=None, texts=None):
+        Q = np.asarray(Q, dtype=np.float32)
+        kw = {} if params is None else {"params": params}
+        if texts is None or self.mode == "off":
+            return self.ix.search(Q, k, **kw)
+        D = np.full((len(Q), k), np.inf, dtype=np.float32)
+        labels = np.full((len(Q), k), -1, dtype=np.int64)
+        vec, fuse, short = [], {}, {}  # short: row -> lexical hits, fewer than k
+        for r, (q, text) in enumerate(zip(Q, texts)):
+            ids, _, df = self.lex.search(text, LEX_CANDIDATES)
+            rare = max(1, LEX_RARE * self.lex.stats()[0])
+            cand = None
+            if self.mode in ("auto", "filter") and df and df <= rare:
+                cand = self.lex.rows(text, rare)
+                cand = np.concatenate(
+                    [cand, ids[~np.isin(ids, cand)][: max(0, k - len(cand))]]
+                )
+            elif self.mode == "filter" and len(ids) >= k:
+                cand = ids
+            if cand is not None:
+                d, i = self._exact(q, cand, k)
+                D[r, : len(i)], labels[r, : len(i)] = d, i
+                if len(i) < k:
+                    short[r] = i
+            else:
+                vec.append(r)
+                if self.mode == "fuse" and len(ids):
+                    fuse[r] = ids
+        if vec:
+            depth = k * RERANK_FACTOR if fuse else k
+            Dv, Iv = self.ix.search(Q[vec], depth, **kw)
+            for r, d, i in zip(vec, Dv, Iv):
+                if r not in fuse:
+                    D[r], labels[r] = d[:k], i[:k]
+                    continue
+                rrf = {}
+                for ranked in (i[i >= 0], fuse[r][:depth]):
+                    for rank, j in enumerate(ranked.tolist()):
+                        rrf[j] = rrf.get(j, 0.0) + 1.0 / (RRF_K + rank + 1)
+                top = np.asarray(
+                    sorted(rrf, key=rrf.get, reverse=True)[:k], dtype=np.int64
+                )
+                d, i = self._exact(Q[r], top)
+                D[r, : len(i)], labels[r, : len(i)] = d, i
+        if short:  # 2k nearest: at least k of them are not lexical hits already
+            rows = list(short)
+            Dv, Iv = self.ix.search(Q[rows], 2 * k, **kw)
+            for r, d, i in zip(rows, Dv, Iv):
+                new = (i >= 0) & ~np.isin(i, short[r])
+                d = np.concatenate([D[r, : len(short[r])], d[new]])
+                i = np.concatenate([short[r], i[new]])
+                o = np.argsort(d, kind="stable")[:k]
+                D[r, : len(o)], labels[r, : len(o)] = d[o], i[o]
+        return D, labels
+
+
+def searchable(ix, X, lex=None):  # what query callers should search
+    ix = RerankIndex(ix, X) if index_kind(ix) in COMPRESSED else ix
+    return ix if lex is None or LEXICAL == "off" else LexicalIndex(ix, X, lex)
+
+
+def unwrap(ix):
+    while isinstance(ix, (RerankIndex, LexicalIndex)):
+        ix = ix.ix
+    return ix
+
+
+# Metadata filters: doc names and a page range compile to chunk ids through the
+# manifest's per-document id ranges (pages within a range are in order, so a page
+# range is two binary searches), then to a FAISS IDSelector. Subsets up to
+# FILTER_SCAN_MAX are scored exactly from their stored vectors, so a filtered query
+# costs what its subset costs; larger ones pass the selector into the index search.
+
+
+def doc_ranges(manifest, metas):  # doc name (as in metas) -> [start, stop) id ranges
+    out = {}
+    if not has_ids(manifest):  # pre-id {path: sig}: all rows live, runs read from metas
+        a = 0
+        for doc, run in groupby(metas[i]["doc"] for i in range(len(metas))):
+            n = sum(1 for _ in run)
+            out.setdefault(doc, []).append([a, a + n])
+            a += n
+        return out
+    for p, e in manifest.items():
+        out.setdefault(Path(p).name, []).extend(e["ids"])
+    return out
+
+
+def meta_pages(metas, a, b):  # page column of rows [a, b), sliced from the stores
+    if isinstance(metas, RenamedMetas):  # a rename keeps the pages
+        return meta_pages(metas.metas, a, b)
+    if isinstance(metas, SegmentedList):
+        cols = [np.zeros(0, np.int32)]
+        for part, s in zip(metas.parts, metas.starts):
+            lo, hi = max(a, s), min(b, s + len(part))
+            if lo < hi:
+                cols.append(meta_pages(part, lo - s, hi - s))
+        return np.concatenate(cols)
+    if isinstance(metas, MetaStore) and a < metas.n:
+        if b <= metas.n:
+            return np.asarray(metas.rows[a:b, 1])
+        return np.concatenate([metas.rows[a:, 1], meta_pages(metas, metas.n, b)])
+    return np.asarray([metas[i]["page"] for i in range(a, b)], dtype=np.int32)
+
+
+# returns sorted chunk ids, or None when there is no filter
+def select_ids(manifest, metas, docs=None, pages=None):
+    if not docs and not pages:
+        return None
+    table = doc_ranges(manifest, metas)
+    names = (
+        table
+        if not docs
+        else [Path(d).name for d in ([docs] if isinstance(docs, str) else docs)]
+    )
+    parts = []
+    for name in names:
+        for a, b in table.get(name, ()):
+            if pages:
+                col = meta_pages(metas, a, b)
+                a, b = a + int(np.searchsorted(col, pages[0])), a + int(
+                    np.searchsorted(col, pages[1], "right")
+                )
+            parts.append(np.arange(a, b, dtype=np.int64))
+    return np.unique(np.concatenate(parts)) if parts else np.zeros(0, np.int64)
+
+
+def id_selector(ids):  # one contiguous run -> IDSelectorRange, else a batch (hash set)
+    if len(ids) and ids[-1] - ids[0] + 1 == len(ids):
+        return faiss.IDSelectorRange(int(ids[0]), int(ids[-1]) + 1)
+    return faiss.IDSelectorBatch(np.ascontiguousarray(ids, dtype=np.int64))
+
+
+def search_params(ix, sel):  # selector plus the index's own search-time knobs
+    ix = unwrap(ix)
+    inner = _inner(ix)
+    if hasattr(ix, "nprobe"):
+        return faiss.SearchParametersIVF(sel=sel, nprobe=ix.nprobe)
+    if hasattr(inner, "hnsw"):
+        return faiss.SearchParametersHNSW(sel=sel, efSearch=inner.hnsw.efSearch)
+    return faiss.SearchParameters(sel=sel)
+
+
+def search_subset(index, Q, k, ids):  # D, labels over chunk ids only
+    Q = np.asarray(Q, dtype=np.float32)
+    if len(ids) <= FILTER_SCAN_MAX:
+        if not len(ids):
+            return np.full((len(Q), k), np.inf, np.float32), np.full(
+                (len(Q), k), -1, np.int64
+            )
+        D, labels = faiss.knn(Q, hit_vectors(index, ids), k)
+        return D, np.where(labels >= 0, ids[np.maximum(labels, 0)], -1)
+    sel = id_selector(ids)
+    return index.search(Q, k, params=search_params(index, sel))
+
+
+def build_index(chunks, cache=None):
+    X = cache.encode(chunks) if cache is not None else encode(chunks)
+    return make_index(X, np.arange(len(X))), X
+
+
+# Pagefile layout (a directory, versioned by meta.json["version"]):
+#   meta.json            version, snapshot, model, encoder (encoder_tag), manifest,
+#                        segments [{name, start, n}], next (number of the next segment)
+#   snap-NNNNNNNN.json   copies of the current and the KEEP_SNAPSHOTS previous meta.json
+#   seg-NNNNNN/          rows [start, start + n), laid out as below (a version 1
+#                        pagefile is exactly one such segment, plus its manifest)
+# Segment layout:
+#   meta.json            version, n, start, dim, x_mode, model, encoder, docs, lex
+#   vectors.f32          raw float32 [n, dim], opened with np.memmap (absent when
+#                        x_mode is "index": rows are reconstructed from index.faiss)
+#   index.faiss          faiss.write_index; queries read it memory-mapped
+#   chunks.bin/.off      utf-8 chunk texts + int64 offsets [n + 1]
+#   metas.i32            int32 [n, 3] = (index into the segment's "docs", page, chunk)
+#   terms.bin/.off       sorted lexicon terms, laid out like chunks.bin/.off
+#   postings.off/.ids/.tf  int64 [terms + 1] offsets, int64 rows, int32 term counts
+#   lens.i32             int32 [n] tokens per chunk, 0 for retired rows
+# index.faiss holds global chunk ids; every other file is addressed by id - start.
+#
+# Snapshots: a writer (holding writer_lock) only adds new segment directories, then
+# publishes them by replacing meta.json, numbered by a snapshot counter that only
+# goes up. Readers never lock: they open whatever meta.json names, and a segment is
+# deleted only once no kept snapshot names it. Rollback republishes a kept snapshot.
+# A CLI query tries writer_lock without waiting; if a writer has it, the query
+# answers from the current snapshot rather than queueing behind the write.
+# Everything is mapped read-only, so loading is cheap and the OS page cache is
+# shared by every process serving the same pagefile. A legacy pickled page.file
+# still loads; convert_pagefile migrates it.
+
+
+class StoredList:  # list-like view over an on-disk column; extend() stays in memory
+    def __init__(self, n):
+        self.n, self.tail = n, []
+
+    def __len__(self):
+        return self.n + len(self.tail)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.load(i) if i < self.n else self.tail[i - self.n]
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def extend(self, items):
+        self.tail.extend(items)
+
+
+class TextStore(StoredList):
+    def __init__(self, buf, offs):
+        super().__init__(len(offs) - 1)
+        self.buf, self.offs = buf, offs
+
+    def load(self, i):
+        return bytes(self.buf[self.offs[i] : self.offs[i + 1]]).decode("utf-8")
+
+
+class MetaStore(StoredList):
+    def __init__(self, rows, docs):
+        super().__init__(len(rows))
+        self.rows, self.docs = rows, docs
+
+    def load(self, i):
+        d, p, c = self.rows[i]
+        return {"doc": self.docs[d], "page": int(p), "chunk": int(c)}
+
+
+class RenamedMetas(StoredList):  # metas of renamed documents report their new file name
+    def __init__(self, metas, names):  # names: sorted [(start, stop, doc)] id ranges
+        super().__init__(len(metas))
+        self.metas, self.names, self.starts = metas, names, [a for a, _, _ in names]
+
+    def load(self, i):
+        m = self.metas[i]
+        j = bisect.bisect_right(self.starts, i) - 1
+        return {**m, "doc": self.names[j][2]} if j >= 0 and i < self.names[j][1] else m
+
+
+# X without a second resident copy of the embeddings. Both views support len,
+# .shape, X[i] / X[ids], np.asarray(X) (materializes) and .append(rows).
+
+
+class MappedVectors:  # rows in vectors.f32; appended rows stay in memory until saved
+    def __init__(self, base):
+        self.base, self.tail = base, np.zeros((0, base.shape[1]), np.float32)
+
+    @property
+    def shape(self):
+        return (len(self.base) + len(self.tail), self.base.shape[1])
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, ids):
+        ids = np.asarray(ids)
+        n = len(self.base)
+        if ids.ndim == 0:
+            return self.base[ids] if ids < n else self.tail[ids - n]
+        out = np.empty((len(ids), self.shape[1]), np.float32)
+        old = ids < n
+        out[old] = self.base[ids[old]]
+        out[~old] = self.tail[ids[~old] - n]
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+        return np.vstack([self.base, self.tail]).astype(dtype or np.float32, copy=False)
+
+    def append(self, rows):
+        self.tail = np.vstack([self.tail, np.asarray(rows, np.float32)])
+        return self
+
+    def tofile(self, f):
+        self.base.tofile(f)
+        self.tail.tofile(f)
+
+
+class IndexVectors:  # rows reconstructed from the (uncompressed) index on demand
+    def __init__(self, ix, n=None, start=0):  # start: id of row 0 (segments)
+        self.ix, self.n, self.start = ix, ix.ntotal if n is None else n, start
+
+    @property
+    def shape(self):
+        return (self.n, self.ix.d)
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, ids):  # ids of retired rows are no longer in the index
+        ids = np.asarray(ids, dtype=np.int64) + self.start
+        if ids.ndim == 0:
+            return self.ix.reconstruct(int(ids))
+        return self.ix.reconstruct_batch(ids)
+
+    def __array__(self, dtype=None, copy=None):  # retired rows come back as zeros
+        out = np.zeros(self.shape, np.float32)
+        rows = index_ids(self.ix) - self.start
+        if len(rows):
+            out[rows] = self[rows]
+        return out.astype(dtype or np.float32, copy=False)
+
+    def append(self, rows):  # rows were added to the index itself
+        self.n += len(rows)
+        return self
+
+    def tofile(self, f):
+        np.asarray(self).tofile(f)
+
+
+def as_vectors(X):
+    return X if hasattr(X, "append") else MappedVectors(np.asarray(X, np.float32))
+
+
+# Segmented pagefiles: chunks, metas and X of consecutive segments read as one
+# store addressed by chunk id; the index fans each query out to every segment and
+# merges their top-k. Rows of retired documents stay in their segment until a
+# compaction drops them, and are kept out of results by an IDSelector.
+
+
+class SegmentedList:  # chunk id -> (segment, row) over per-segment stores
+    def __init__(self, parts, starts):
+        self.parts, self.starts = parts, [int(a) for a in starts]
+
+    def __len__(self):
+        return self.starts[-1] + len(self.parts[-1]) if self.parts else 0
+
+    def _at(self, i):
+        s = bisect.bisect_right(self.starts, i) - 1
+        return self.parts[s], i - self.starts[s]
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        part, j = self._at(i)
+        return part[j]
+
+    def __iter__(self):
+        for p in self.parts:
+            yield from p
+
+
+class SegmentedVectors(SegmentedList):
+    @property
+    def shape(self):
+        return (len(self), self.parts[0].shape[1])
+
+    def __getitem__(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        if ids.ndim == 0:
+            part, j = self._at(int(ids))
+            return part[j]
+        out = np.empty((len(ids), self.shape[1]), np.float32)
+        seg = np.searchsorted(self.starts, ids, "right") - 1
+        for s in np.unique(seg):
+            m = seg == s
+            out[m] = self.parts[s][ids[m] - self.starts[s]]
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+        return np.vstack([np.asarray(p) for p in self.parts]).astype(
+            dtype or np.float32, copy=False
+        )
+
+    def tofile(self, f):
+        for p in self.parts:
+            p.tofile(f)
+
+
+class SegmentedIndex:  # per-segment indexes searched as one; dead ids never come back
+    def __init__(self, parts, X, dead=()):  # parts: [(start, stop, index)]
+        self.X, self.parts, self._keep = X, [], []
+        dead = np.asarray(dead, dtype=np.int64)
+        for a, b, ix in parts:
+            d = dead[(dead >= a) & (dead < b)]
+            sel = None
+            if len(d):
+                inner = faiss.IDSelectorBatch(d)
+                sel = faiss.IDSelectorNot(inner)
+                self._keep.append(inner)  # IDSelectorNot does not own it
+            self.parts.append((a, b, searchable(ix, X), sel))
+
+    @property
+    def ntotal(self):
+        return sum(ix.ntotal for _, _, ix, _ in self.parts)
+
+    @property
+    def d(self):
+        return self.X.shape[1]
+
+    def reconstruct(self, i):
+        return self.X[int(i)]
+
+    def reconstruct_batch(self, ids):
+        return live_vectors(self.X, np.asarray(ids, dtype=np.int64))
+
+    def search(self, Q, k, params=None):
+        Q = np.asarray(Q, dtype=np.float32)
+        want = None if params is None else params.sel
+        Ds, Ls = [], []
+        for _, _, ix, dead in self.parts:
+            sel = want if dead is None else dead
+            if want is not None and dead is not None:
+                sel = faiss.IDSelectorAnd(want, dead)
+            kw = {} if sel is None else {"params": search_params(ix, sel)}
+            D, labels = ix.search(Q, k, **kw)
+            Ds.append(D)
+            Ls.append(labels)
+        D, labels = np.hstack(Ds), np.hstack(Ls)
+        D[labels < 0] = np.inf
+        o = np.argsort(D, axis=1, kind="stable")[:, :k]
+        return np.take_along_axis(D, o, 1), np.take_along_axis(labels, o, 1)
+
+
+def _mmap(path, dtype, shape):
+    if not shape[0]:
+        return np.zeros(shape, dtype)  # mmap refuses empty files
+    return np.memmap(path, dtype=dtype, mode="r", shape=shape)
+
+
+def _rm(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def _replace_dir(tmp, path):  # readers holding maps of the old files keep working
+    old = path + ".old"
+    _rm(old)
+    if os.path.exists(path):
+        os.rename(path, old)
+    os.rename(tmp, path)
+    _rm(old)
+
+
+def read_index(path, mmap=True):  # mmapped indexes are read-only: never add() to them
+    flag = getattr(faiss, "IO_FLAG_MMAP_IFC", 0) if mmap else 0
+    try:
+        return tune_index(faiss.read_index(path, flag))
+    except RuntimeError:
+        return tune_index(faiss.read_index(path))
+
+
+def x_mode_for(ix, x_mode=None):  # compressed codes cannot reconstruct exact rows
+    return "mmap" if index_kind(ix) in COMPRESSED else x_mode or X_MODE
+
+
+def _write_texts(stem, texts):  # stem.bin (utf-8) + stem.off (int64 [len + 1])
+    offs = [0]
+    with open(stem + ".bin", "wb") as f:
+        for t in texts:
+            b = t.encode("utf-8")
+            f.write(b)
+            offs.append(offs[-1] + len(b))
+    np.asarray(offs, dtype=np.int64).tofile(stem + ".off")
+    return len(offs) - 1
+
+
+def _map_texts(stem, n):  # what _write_texts wrote, as a read-only TextStore
+    offs = _mmap(stem + ".off", np.int64, (n + 1,))
+    return TextStore(_mmap(stem + ".bin", np.uint8, (int(offs[-1]),)), offs)
+
+
+class PagefileWriter:  # rows go to path + ".tmp"; close() adds the index, swaps it in
+    def __init__(self, path, start=0):  # start: chunk id of the first row
+        self.path, self.tmp, self.start = path, path + ".tmp", start
+        _rm(self.tmp)
+        os.makedirs(self.tmp)
+        self.n, self.end, self.d, self.docs = 0, 0, None, {}
+        names = ("vectors.f32", "chunks.bin", "chunks.off", "metas.i32")
+        self.files = {name: open(os.path.join(self.tmp, name), "wb") for name in names}
+        np.zeros(1, np.int64).tofile(self.files["chunks.off"])
+
+    def add(self, chunks, metas, X=None):  # X=None: rows are read from the index
+        offs = []
+        for c in chunks:
+            b = c.encode("utf-8")
+            self.files["chunks.bin"].write(b)
+            self.end += len(b)
+            offs.append(self.end)
+        np.asarray(offs, dtype=np.int64).tofile(self.files["chunks.off"])
+        rows = [
+            (self.docs.setdefault(m["doc"], len(self.docs)), m["page"], m["chunk"])
+            for m in metas
+        ]
+        np.asarray(rows, dtype=np.int32).reshape(-1, 3).tofile(self.files["metas.i32"])
+        if X is not None:
+            self.d = X.shape[1]
+            as_vectors(X).tofile(self.files["vectors.f32"])
+        self.n += len(offs)
+
+    def spill(self, lex):  # lex's in-memory postings -> a run file set beside the rows
+        lex.spill(os.path.join(self.tmp, f"lexrun-{len(lex.runs):06d}"))
+
+    def vectors(self):  # rows written so far, mapped read-only
+        self.files["vectors.f32"].flush()
+        return _mmap(
+            os.path.join(self.tmp, "vectors.f32"), np.float32, (self.n, self.d)
+        )
+
+    def close(self, ix, lex=None, x_mode=None):  # ix holds chunk ids start .. start + n
+        for f in self.files.values():
+            f.close()
+        ix = unwrap(ix)
+        x_mode = x_mode_for(ix, x_mode)
+        if x_mode == "index":
+            _rm(os.path.join(self.tmp, "vectors.f32"))
+        faiss.write_index(ix, os.path.join(self.tmp, "index.faiss"))
+        meta = {
+            "version": 1,
+            "n": self.n,
+            "start": self.start,
+            "dim": int(ix.d),
+            "x_mode": x_mode,
+            "model": MODEL_NAME,
+            "encoder": encoder_tag(),
+            "docs": list(self.docs),
+        }
+        if lex is not None:
+            meta["lex"] = lex.save(self.tmp)
+        for f in os.listdir(self.tmp):  # spilled runs, merged into the lexicon now
+            if f.startswith("lexrun-"):
+                os.remove(os.path.join(self.tmp, f))
+        with open(os.path.join(self.tmp, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        _replace_dir(self.tmp, self.path)
+
+
+def segment_name(i):
+    return f"seg-{i:06d}"
+
+
+try:
+    import fcntl
+except ImportError:  # no flock (Windows): writers serialized within this process only
+    fcntl = None
+
+# writers in this process; reentrant (update_pagefile -> build_pagefile)
+_write_lock = threading.RLock()
+_lock_files = {}  # pagefile -> [locked file, depth], under _write_lock
+
+
+@contextmanager
+def writer_lock(path=PAGE_FILE, wait=True):
+    # one writer per pagefile, across processes via flock(path + ".lock");
+    # wait=False raises BlockingIOError instead of queueing behind another writer
+    if not _write_lock.acquire(blocking=wait):
+        raise BlockingIOError(f"{path} is being written")
+    try:
+        key = os.path.abspath(path)
+        if key not in _lock_files:
+            f = open(key + ".lock", "a")
+            if fcntl is not None:
+                try:  # released when f is closed
+                    fcntl.flock(f, fcntl.LOCK_EX | (0 if wait else fcntl.LOCK_NB))
+                except OSError:
+                    f.close()
+                    raise BlockingIOError(f"{path} is being written") from None
+            _lock_files[key] = [f, 0]
+        held = _lock_files[key]
+        held[1] += 1
+        try:
+            yield
+        finally:
+            held[1] -= 1
+            if not held[1]:
+                del _lock_files[key]
+                held[0].close()
+    finally:
+        _write_lock.release()
+
+
+def snapshot_name(v):
+    return f"snap-{v:08d}.json"
+
+
+def snapshots(path=PAGE_FILE):  # kept snapshot numbers, oldest first
+    return sorted(
+        int(f[5:-5])
+        for f in os.listdir(path)
+        if f.startswith("snap-") and f.endswith(".json")
+    )
+
+
+# call under writer_lock; returns the new snapshot number
+def publish(path, manifest, segments, next_seg, keep=KEEP_SNAPSHOTS):
+    # meta.json is replaced atomically: readers see the old snapshot or the new one
+    v = max(snapshots(path), default=0) + 1
+    meta = {
+        "version": PAGEFILE_VERSION,
+        "snapshot": v,
+        "model": MODEL_NAME,
+        "encoder": encoder_tag(),
+        "segments": segments,
+        "next": next_seg,
+        "manifest": manifest,
+    }
+    tmp = os.path.join(path, "meta.json.tmp")
+    with open(tmp, "w") as f:
+        json.dump(meta, f)
+    shutil.copyfile(tmp, os.path.join(path, snapshot_name(v)))
+    os.replace(tmp, os.path.join(path, "meta.json"))
+    prune_snapshots(path, keep)
+    return v
+
+
+# drop old snapshots, then segments (and leftovers) no kept snapshot names
+def prune_snapshots(path, keep=KEEP_SNAPSHOTS):
+    kept = snapshots(path)
+    for v in kept[: -(keep + 1)]:
+        os.remove(os.path.join(path, snapshot_name(v)))
+    used = {
+        s["name"] for v in kept[-(keep + 1) :] for s in read_meta(path, v)["segments"]
+    }
+    for name in os.listdir(path):
+        if name.startswith("seg-") and name not in used:
+            _rm(os.path.join(path, name))
+
+
+def read_meta(path, snapshot=None):  # meta.json, or a kept snapshot of it
+    with open(
+        os.path.join(path, "meta.json" if snapshot is None else snapshot_name(snapshot))
+    ) as f:
+        return json.load(f)
+
+
+def segment_root(path):  # -> (directory for new segments, next segment number)
+    # A segmented pagefile is added to in place; anything else (none yet, version 1,
+    # pickle) is written to path + ".tmp" and swapped in whole by end_write.
+    try:
+        meta = read_meta(path)
+        if meta["version"] == PAGEFILE_VERSION:
+            return path, meta["next"]
+    except (OSError, ValueError):
+        pass
+    tmp = path + ".tmp"
+    _rm(tmp)
+    os.makedirs(tmp)
+    return tmp, 1
+
+
+def end_write(root, path):
+    if root != path:
+        _replace_dir(root, path)
+
+
+# republish a kept snapshot; default: the previous one
+def rollback_pagefile(path=PAGE_FILE, snapshot=None):
+    with writer_lock(path):
+        meta = read_meta(path)
+        if snapshot is None:
+            older = [v for v in snapshots(path) if v < meta.get("snapshot", 0)]
+            if not older:
+                raise ValueError(f"{path}: no earlier snapshot kept")
+            snapshot = older[-1]
+        try:
+            old = read_meta(path, snapshot)
+        except FileNotFoundError:
+            raise ValueError(
+                f"{path}: snapshot {snapshot} is not kept (have {snapshots(path)})"
+            ) from None
+        v = publish(path, old["manifest"], old["segments"], meta["next"])
+    cache = get_answer_cache()
+    cache.invalidate()  # ids refer to another snapshot now
+    cache.save()
+    return v
+
+
+def write_segment(path, start, chunks, metas, X, lex, live=None, x_mode=None):
+    # rows [start, start + len(chunks)) with vectors X; live: ids to index (default all)
+    ids = (
+        np.arange(start, start + len(chunks), dtype=np.int64) if live is None else live
+    )
+    ix = make_index(live_vectors(X, ids - start), ids)
+    w = PagefileWriter(path, start)
+    w.add(chunks, metas, None if x_mode_for(ix, x_mode) == "index" else X)
+    w.close(ix, lex, x_mode)
+    return {"name": os.path.basename(path), "start": start, "n": len(chunks)}
+
+
+# writes everything as a single segment
+def save_pagefile(
+    ix, X, chunks, metas, manifest, path=PAGE_FILE, x_mode=None, lex=None
+):
+    with writer_lock(path):
+        root, nxt = segment_root(path)
+        w = PagefileWriter(os.path.join(root, segment_name(nxt)))
+        w.add(chunks, metas, None if x_mode_for(unwrap(ix), x_mode) == "index" else X)
+        w.close(ix, lex, x_mode)
+        publish(
+            root, manifest, [{"name": segment_name(nxt), "start": 0, "n": w.n}], nxt + 1
+        )
+        end_write(root, path)
+
+
+def open_vectors(path, ix, x_mode, n, d, start=0):
+    if x_mode == "index":
+        return IndexVectors(ix, n, start)
+    return MappedVectors(_mmap(os.path.join(path, "vectors.f32"), np.float32, (n, d)))
+
+
+def check_encoder(path, meta):
+    enc = meta.get("encoder", f"torch:{meta['model']}")
+    if enc != encoder_tag():
+        fix = "set RAG_EMBED to match or rebuild"
+        raise ValueError(f"{path}: vectors come from {enc}, not {encoder_tag()}; {fix}")
+
+
+def load_segment(path, mmap=True):
+    meta = read_meta(path)
+    check_encoder(path, meta)
+    n, d, start = meta["n"], meta["dim"], meta.get("start", 0)
+    offs = _mmap(os.path.join(path, "chunks.off"), np.int64, (n + 1,))
+    ix = read_index(os.path.join(path, "index.faiss"), mmap)
+    return {
+        "ix": ix,
+        "X": open_vectors(path, ix, meta.get("x_mode", "mmap"), n, d, start),
+        "chunks": TextStore(
+            _mmap(os.path.join(path, "chunks.bin"), np.uint8, (int(offs[-1]),)), offs
+        ),
+        "metas": MetaStore(
+            _mmap(os.path.join(path, "metas.i32"), np.int32, (n, 3)), meta["docs"]
+        ),
+        "lex": load_lexicon(path, meta["lex"], n) if "lex" in meta else None,
+        "start": start,
+        "n": n,
+    }
+
+
+def load_pagefile(path=PAGE_FILE, mmap=True):
+    if os.path.isfile(path):  # legacy single pickle
+        with open(path, "rb") as f:
+            pf = pickle.load(f)
+        pf["X"] = as_vectors(pf["X"])
+        return pf
+    meta = read_meta(path)
+    check_encoder(path, meta)
+    if meta["version"] == 1:  # one segment, rows already removed from its index
+        return {**load_segment(path, mmap), "manifest": meta["manifest"]}
+    if meta["version"] != PAGEFILE_VERSION:
+        raise ValueError(f"{path}: unsupported pagefile version {meta['version']}")
+    segs = [load_segment(os.path.join(path, s["name"]), mmap) for s in meta["segments"]]
+    starts = [s["start"] for s in segs]
+    X = SegmentedVectors([s["X"] for s in segs], starts)
+    manifest = meta["manifest"]
+    metas = SegmentedList([s["metas"] for s in segs], starts)
+    dead, renamed = np.zeros(0, np.int64), []
+    if has_ids(manifest):  # else a converted pickle: all rows live until its rebuild
+        dead = np.setdiff1d(np.arange(len(X), dtype=np.int64), live_ids(manifest))
+        renamed = [
+            (a, b, Path(p).name) for p, e in manifest.items() for a, b in e["ids"]
+        ]
+        renamed = sorted(
+            r for r in renamed if r[1] > r[0] and metas[r[0]]["doc"] != r[2]
+        )
+    if renamed:
+        metas = RenamedMetas(metas, renamed)
+    lex = None
+    if all(s["lex"] is not None for s in segs):
+        lex = Lexicon.merge([s["lex"] for s in segs], starts)
+        lex.retire(dead)
+    return {
+        "ix": SegmentedIndex(
+            [(s["start"], s["start"] + s["n"], s["ix"]) for s in segs], X, dead
+        ),
+        "X": X,
+        "chunks": SegmentedList([s["chunks"] for s in segs], starts),
+        "metas": metas,
+        "manifest": manifest,
+        "lex": lex,
+        "segments": meta["segments"],
+        "next": meta["next"],
+    }
+
+
+def convert_pagefile(src=LEGACY_PAGE_FILE, dst=PAGE_FILE):
+    pf = load_pagefile(src)
+    save_pagefile(
+        pf["ix"],
+        pf["X"],
+        pf["chunks"],
+        pf["metas"],
+        pf["manifest"],
+        dst,
+        lex=ensure_lexicon(pf),
+    )
+    return dst
+
+
+# Build fresh (first run). A streaming pipeline: PDFs go extract -> chunk ->
+# encode -> write in steps of at most `batch` chunks (fewer once their text passes
+# mem_mb), so only one step's text and vectors are resident however large the
+# corpus. Each step's BM25 postings go to a sorted run on disk, which close()
+# k-way merges into the lexicon. The index is then built from the written
+# vectors.f32 map, `batch` rows at a time; it is the only corpus-sized part left,
+# apart from a token count per chunk and an offset per distinct term.
+
+
+def build_pagefile(
+    pdf_dir=PDF_DIR,
+    path=PAGE_FILE,
+    workers=EXTRACT_WORKERS,
+    cache_path=EMB_CACHE,
+    batch=BUILD_BATCH,
+    mem_mb=BUILD_MEM_MB,
+    encode_workers=ENCODE_WORKERS,
+):
+    pdfs = list(Path(pdf_dir).glob("*.pdf"))
+    sigs = {str(p): file_sig(p) for p in pdfs}
+    with writer_lock(path):
+        root, nxt = segment_root(path)
+        w = PagefileWriter(os.path.join(root, segment_name(nxt)))
+        lex, pages = Lexicon(), {}
+        with EncoderPool(encode_workers) as enc:
+            cache = EmbeddingCache(cache_path, encoder=enc)
+            for chunks, metas in iter_chunk_batches(
+                pdfs, pages, workers, batch, mem_mb
+            ):
+                lex.add(w.n, chunks)
+                w.spill(lex)
+                w.add(chunks, metas, cache.encode(chunks))
+        if w.d is None:  # no text at all
+            w.d = cache.encode([]).shape[1]
+        ix = make_index(w.vectors(), np.arange(w.n), batch=batch)
+        manifest = {
+            p: {
+                "sig": s,
+                "hash": content_hash(p),
+                "pages": pages.get(p, []),
+                "ids": page_ranges(pages.get(p, [])),
+            }
+            for p, s in sigs.items()
+        }
+        for p in set(sigs) - set(pages):  # timed out: retried once its sig changes
+            manifest[p]["failed"] = "timeout"
+        w.close(ix, lex)
+        del ix
+        publish(
+            root, manifest, [{"name": segment_name(nxt), "start": 0, "n": w.n}], nxt + 1
+        )
+        end_write(root, path)
+        pf = load_pagefile(path)
+        cache.save(live=pf["chunks"])  # under the lock: live is still the whole corpus
+    del cache
+    cache = get_answer_cache()
+    cache.invalidate()  # fresh ids
+    cache.save()
+    return (
+        searchable(pf["ix"], pf["X"], pf["lex"]),
+        pf["X"],
+        pf["chunks"],
+        pf["metas"],
+        pf["manifest"],
+    )
+
+
+COMPACT_DEAD_FRACTION = 0.25  # rewrite the row stores once this share is retired
+
+
+def has_ids(manifest):  # False for pre-id {path: sig} manifests (pickled pagefiles)
+    return all(isinstance(e, dict) for e in manifest.values())
+
+
+def live_ids(manifest):
+    return np.sort(range_ids([r for e in manifest.values() for r in e["ids"]]))
+
+
+def live_vectors(X, ids):
+    return np.asarray(X[ids], dtype=np.float32).reshape(len(ids), X.shape[1])
+
+
+# rewrite the live rows, renumbered densely, as one segment; vectors are reused.
+# Rows stream through a PagefileWriter in batch slices, like build_pagefile.
+def compact_pagefile(path=PAGE_FILE, batch=BUILD_BATCH):
+    with writer_lock(path):
+        pf = load_pagefile(path)
+        live = live_ids(pf["manifest"])
+        root, nxt = segment_root(path)
+        w = PagefileWriter(os.path.join(root, segment_name(nxt)))
+        lex = Lexicon()
+        for s in range(0, len(live), batch):
+            ids = live[s : s + batch]
+            chunks = [pf["chunks"][i] for i in ids]
+            lex.add(w.n, chunks)
+            w.spill(lex)
+            w.add(chunks, [pf["metas"][i] for i in ids], live_vectors(pf["X"], ids))
+        if w.d is None:  # nothing live
+            w.d = pf["X"].shape[1]
+        ix = make_index(w.vectors(), np.arange(w.n), batch=batch)
+
+        def at(i):  # old id -> new id
+            return int(np.searchsorted(live, i))
+
+        manifest = pf["manifest"]
+        for e in manifest.values():
+            e["ids"] = [[at(a), at(b)] for a, b in e["ids"]]
+            if "pages" in e:
+                e["pages"] = [[pg, h, at(a), at(b)] for pg, h, a, b in e["pages"]]
+                e["ids"] = page_ranges(e["pages"])
+        del pf
+        w.close(ix, lex)
+        del ix
+        publish(
+            root, manifest, [{"name": segment_name(nxt), "start": 0, "n": w.n}], nxt + 1
+        )
+        end_write(root, path)
+
+
+# Update (incremental add/modify/delete), append-only: the changed pages of changed
+# PDFs and added PDFs are encoded into one new segment under fresh ids, and the id
+# ranges of deleted PDFs and changed pages just leave the manifest (their rows turn
+# into tombstones); then meta.json is replaced atomically. Old segments are never
+# rewritten here, so an update costs what its new PDFs cost. Past SEGMENTS_MAX
+# segments, a background thread merges the smallest neighbours (ids are kept); past
+# COMPACT_DEAD_FRACTION tombstones, or once the corpus outgrows the first segment's
+# index (needs_rebuild), the whole pagefile is compacted into one renumbered,
+# retrained segment.
+
+SEGMENTS_MAX = 8
+
+
+# wait=False: BlockingIOError while another writer holds the pagefile
+def update_pagefile(
+    pdf_dir=PDF_DIR,
+    path=PAGE_FILE,
+    workers=EXTRACT_WORKERS,
+    cache_path=EMB_CACHE,
+    encode_workers=ENCODE_WORKERS,
+    wait=True,
+):
+    with writer_lock(path, wait):
+        if not os.path.exists(path):
+            return build_pagefile(
+                pdf_dir, path, workers, cache_path, encode_workers=encode_workers
+            )
+        pf = load_pagefile(path)
+        old = pf["manifest"]
+
+        if not has_ids(old):
+            # Pre-id manifest (no per-document ranges): rebuild once; the embedding
+            # cache keeps that from re-encoding unchanged chunks.
+            return build_pagefile(
+                pdf_dir, path, workers, cache_path, encode_workers=encode_workers
+            )
+
+        # single-segment pagefile: migrate once
+        if pf.get("segments") is None or pf["lex"] is None:
+            save_pagefile(
+                pf["ix"],
+                pf["X"],
+                pf["chunks"],
+                pf["metas"],
+                old,
+                path,
+                lex=ensure_lexicon(pf),
+            )
+            pf = load_pagefile(path)
+
+        manifest, todo, retired = diff_manifest(old, Path(pdf_dir).glob("*.pdf"))
+        if not todo and manifest == old:
+            return (
+                searchable(pf["ix"], pf["X"], pf["lex"]),
+                pf["X"],
+                pf["chunks"],
+                pf["metas"],
+                old,
+            )
+
+        n = len(pf["chunks"])
+        # changed PDFs: diff by page against their old entry, unless a rename moved
+        # that entry (and its ids) to another path
+        prev = {p: old[p]["pages"] for p in retired if p in todo and "pages" in old[p]}
+        new_chunks, new_metas, pages = chunk_files(
+            list(todo), workers, start=n, prev=prev
+        )
+        moved_away = set(old) - set(retired)  # renamed: their ids live on elsewhere
+        for p, e in todo.items():
+            if p in pages:
+                manifest[p] = {**e, "pages": pages[p], "ids": page_ranges(pages[p])}
+            elif p in old and p not in moved_away:  # timed out: keep the old version
+                manifest[p] = {**old[p], **e, "failed": "timeout"}
+            else:  # timed out; recorded so it is retried only once its sig changes
+                manifest[p] = {**e, "pages": [], "ids": [], "failed": "timeout"}
+        gone = np.setdiff1d(
+            range_ids([r for p in retired for r in old[p]["ids"]]), live_ids(manifest)
+        )
+
+        segments, nxt = list(pf["segments"]), pf["next"]
+        if new_chunks:
+            with EncoderPool(encode_workers) as enc:
+                cache = EmbeddingCache(cache_path, encoder=enc)
+                X_new = cache.encode(new_chunks)
+            cache.save()
+            seg = os.path.join(path, segment_name(nxt))
+            segments.append(
+                write_segment(
+                    seg, n, new_chunks, new_metas, X_new, Lexicon.build(new_chunks)
+                )
+            )
+            nxt += 1
+        publish(path, manifest, segments, nxt)
+        if len(gone):
+            get_answer_cache().invalidate(gone)
+
+        total, live = n + len(new_chunks), len(live_ids(manifest))
+        # the oldest, largest segment
+        base = unwrap(pf["ix"].parts[0][2]) if pf["ix"].parts else None
+        if total - live > COMPACT_DEAD_FRACTION * total or (
+            base is not None and needs_rebuild(base, live)
+        ):
+            compact_pagefile(path)
+            get_answer_cache().invalidate()  # ids were renumbered
+        get_answer_cache().save()
+        pf = load_pagefile(path)
+        if len(pf["segments"]) > SEGMENTS_MAX:
+            threading.Thread(
+                target=compact_segments, args=(path, SEGMENTS_MAX), name="rag-compact"
+            ).start()
+        return (
+            searchable(pf["ix"], pf["X"], pf["lex"]),
+            pf["X"],
+            pf["chunks"],
+            pf["metas"],
+            pf["manifest"],
+        )
+
+
+# merge neighbouring segments; ids stay valid
+def compact_segments(path=PAGE_FILE, max_segments=SEGMENTS_MAX):
+    while True:
+        with writer_lock(path):
+            if not merge_smallest(path, max_segments):
+                return
+
+
+def merge_smallest(path, max_segments):  # -> False when there is nothing to merge
+    meta = read_meta(path)
+    segs = meta["segments"]
+    if len(segs) <= max_segments:
+        return False
+    j = min(range(len(segs) - 1), key=lambda j: segs[j]["n"] + segs[j + 1]["n"])
     pf = load_pagefile(path)
-    old_manifest = pf["manifest"]
-    current = {str(p): file_sig(p) for p in Path(pdf_dir).glob("*.pdf")}
+    a, b = segs[j]["start"], segs[j + 1]["start"] + segs[j + 1]["n"]
+    live = live_ids(meta["manifest"])
+    live = live[(live >= a) & (live < b)]
+    # tombstoned rows are never read again
+    X = np.zeros((b - a, pf["X"].shape[1]), np.float32)
+    X[live - a] = live_vectors(pf["X"], live)
+    chunks = [pf["chunks"][i] for i in range(a, b)]
+    lex = Lexicon.build(chunks)
+    lex.retire(np.setdiff1d(np.arange(b - a), live - a))
+    metas = [pf["metas"][i] for i in range(a, b)]
+    merged = write_segment(
+        os.path.join(path, segment_name(meta["next"])), a, chunks, metas, X, lex, live
+    )
+    del pf
+    publish(
+        path, meta["manifest"], segs[:j] + [merged] + segs[j + 2 :], meta["next"] + 1
+    )
+    return True
+
+
+from concurrent.futures import ThreadPoolExecutor
+
+LLM_MODEL = "gpt-4o-mini"  # or a model you have access to
+LLM_CONCURRENCY = int(os.getenv("RAG_LLM_CONCURRENCY", "4"))  # parallel chat calls
 
-    deleted = set(old_manifest) - set(current)
-    added_or_changed = [p for p, s in current.items() if old_manifest.get(p) != s]
 
-    if deleted:
-        # IndexFlatL2 lacks easy deletions; simplest: full rebuild to stay correct.
-        return build_pagefile(pdf_dir, path)
+def hits_of(D, labels):  # one search row -> [(squared distance, chunk id)], -1 = no hit
+    return [(d, i) for d, i in zip(D.tolist(), labels.tolist()) if i >= 0]
 
-    if not added_or_changed:
-        return pf["ix"], pf["X"], pf["chunks"], pf["metas"], current
 
-    # Append new/changed content
-    new_chunks, new_metas = [], []
-    for p in added_or_changed:
-        for t, meta in load_texts_with_meta(p):
-            cs = chunk_text(t)
-            new_chunks.extend(cs)
-            new_metas.extend([{**meta, "chunk": j + 1} for j in range(len(cs))])
+def make_prompt(query, context):
+    return f"Answer based on context:\n{context}\n\nQuestion: {query}\nAnswer:"
 
-    if new_chunks:
-        X_new = encode(new_chunks)
-        pf["ix"].add(X_new)
-        pf["X"] = np.vstack([pf["X"], X_new])
-        pf["chunks"].extend(new_chunks)
-        pf["metas"].extend(new_metas)
 
-    pf["manifest"] = current
-    save_pagefile(pf["ix"], pf["X"], pf["chunks"], pf["metas"], pf["manifest"], path)
-    return pf["ix"], pf["X"], pf["chunks"], pf["metas"], pf["manifest"]
+# Context packing: order the retrieved chunks by maximal marginal relevance over
+# their stored vectors, drop near-duplicates (the same boilerplate page in several
+# PDFs), and stop at CONTEXT_TOKENS, trimming the last chunk that crosses it.
 
 
-from openai import OpenAI
-import os
+def _tokenizer():  # tiktoken when installed, else ~4 characters per token
+    if "tok" not in _lazy:
+        try:
+            import tiktoken
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+            _lazy["tok"] = tiktoken.get_encoding("o200k_base")
+        except Exception:
+            _lazy["tok"] = None
+    return _lazy["tok"]
 
 
-def query_rag(query, index, chunks, k=TOPK):
-    qvec = encode([query])
-    D, I = index.search(qvec, k)  # D: squared distances, I: indices
-    retrieved = [chunks[i] for i in I[0]]
-    context = "\n\n".join(retrieved)
-    prompt = f"Answer based on context:\n{context}\n\nQuestion: {query}\nAnswer:"
+def count_tokens(text):
+    tok = _tokenizer()
+    return len(tok.encode(text)) if tok else (len(text) + 3) // 4
 
-    resp = client.chat.completions.create(
-        model="gpt-4o-mini",  # or a model you have access to
+
+def trim_tokens(text, n):
+    tok = _tokenizer()
+    return tok.decode(tok.encode(text)[:n]) if tok else text[: 4 * n]
+
+
+def hit_vectors(index, ids):  # stored vectors of retrieved chunks, exact if possible
+    if isinstance(index, (RerankIndex, LexicalIndex)):
+        return live_vectors(index.X, ids)
+    return np.asarray(
+        index.reconstruct_batch(np.asarray(ids, dtype=np.int64)), dtype=np.float32
+    )
+
+
+def pack_context(
+    qvec, hits, chunks, index, budget=CONTEXT_TOKENS, lam=MMR_LAMBDA, dup=DUP_SIM
+):
+    if not hits:
+        return [], ""
+    V = hit_vectors(index, [i for _, i in hits])
+    V /= np.linalg.norm(V, axis=1, keepdims=True) + 1e-12
+    q = np.asarray(qvec, dtype=np.float32).ravel()
+    rel, sim = V @ (q / (np.linalg.norm(q) + 1e-12)), V @ V.T
+    order, left = [], list(range(len(hits)))
+    while left:
+        red = sim[np.ix_(left, order)].max(1) if order else np.zeros(len(left))
+        best = int(np.argmax(lam * rel[left] - (1 - lam) * red))
+        j = left.pop(best)
+        if red[best] < dup:
+            order.append(j)
+    used, parts, total = [], [], 0
+    for j in order:
+        text = chunks[hits[j][1]]
+        room = budget - total - (2 if parts else 0)  # "\n\n" separator
+        if room <= 0:
+            break
+        n = count_tokens(text)
+        if n > room:
+            text, n = trim_tokens(text, room), room
+        used.append(hits[j])
+        parts.append(text)
+        total += n + (2 if len(parts) > 1 else 0)
+    return used, "\n\n".join(parts)
+
+
+def ask_llm(prompt):
+    resp = get_client().chat.completions.create(
+        model=LLM_MODEL,
         messages=[{"role": "user", "content": prompt}],
         temperature=0,
     )
-    return resp.choices[0].message.content, list(zip(D[0].tolist(), I[0].tolist()))
+    return resp.choices[0].message.content
+
+
+def ask_llm_stream(prompt):  # yields answer text deltas as they arrive
+    stream = get_client().chat.completions.create(
+        model=LLM_MODEL,
+        messages=[{"role": "user", "content": prompt}],
+        temperature=0,
+        stream=True,
+    )
+    for ev in stream:
+        if ev.choices and ev.choices[0].delta.content:
+            yield ev.choices[0].delta.content
+
+
+# Semantic answer cache: a stored answer is reused when a new question retrieves
+# the same chunk id set and its vector is within ANSWER_CACHE_SIM (cosine) of the
+# cached question. Entries also carry a hash of the chunk texts, so a pagefile
+# rewritten by another process can never serve a stale answer; update_pagefile
+# drops entries touching retired ids outright.
+
+
+class AnswerCache:
+    def __init__(
+        self,
+        path=ANSWER_CACHE,
+        sim=ANSWER_CACHE_SIM,
+        ttl=ANSWER_CACHE_TTL,
+        max_size=ANSWER_CACHE_MAX,
+    ):
+        self.path, self.sim, self.ttl, self.max_size = path, sim, ttl, max_size
+        self.tag = (encoder_tag(), LLM_MODEL)
+        self.entries = {}  # ids -> [(qvec, sig, answer, t)]
+        self.hits, self.misses, self.dirty = 0, 0, False
+        self.lock = threading.Lock()
+        if path and os.path.exists(path):
+            try:
+                with open(path, "rb") as f:
+                    d = pickle.load(f)
+                if tuple(d["tag"]) == self.tag:
+                    self.entries = d["entries"]
+            except Exception as e:
+                print(f"warn: ignoring unreadable answer cache {path}: {e}")
+
+    @staticmethod
+    def _key(hits):
+        return tuple(sorted(i for _, i in hits))
+
+    @staticmethod
+    def _sig(chunks, hits):  # in id order, like the key: packing order doesn't matter
+        return text_key("\0".join(chunks[i] for i in sorted(i for _, i in hits)))
+
+    @staticmethod
+    def _unit(v):
+        v = np.asarray(v, dtype=np.float32).ravel()
+        return v / (np.linalg.norm(v) or 1.0)
+
+    def get(self, qvec, chunks, hits):
+        q, key, now = self._unit(qvec), self._key(hits), time.time()
+        with self.lock:
+            for v, sig, ans, t in self.entries.get(key, ()):
+                if (
+                    now - t <= self.ttl
+                    and float(v @ q) >= self.sim
+                    and sig == self._sig(chunks, hits)
+                ):
+                    self.hits += 1
+                    return ans
+            self.misses += 1
+        return None
+
+    def put(self, qvec, chunks, hits, ans):
+        with self.lock:
+            self.entries.setdefault(self._key(hits), []).append(
+                (self._unit(qvec), self._sig(chunks, hits), ans, time.time())
+            )
+            self._evict()
+            self.dirty = True
+
+    def _evict(self):
+        now = time.time()
+        for key in list(self.entries):
+            self.entries[key] = [e for e in self.entries[key] if now - e[3] <= self.ttl]
+            if not self.entries[key]:
+                del self.entries[key]
+        n = sum(map(len, self.entries.values()))
+        if n > self.max_size:
+            cut = sorted(e[3] for es in self.entries.values() for e in es)[
+                n - self.max_size
+            ]
+            for key in list(self.entries):
+                self.entries[key] = [e for e in self.entries[key] if e[3] >= cut]
+                if not self.entries[key]:
+                    del self.entries[key]
+
+    def invalidate(self, ids=None):  # ids=None drops all (e.g. after renumbering)
+        with self.lock:
+            gone = None if ids is None else set(np.asarray(ids).tolist())
+            for key in list(self.entries):
+                if gone is None or gone.intersection(key):
+                    del self.entries[key]
+                    self.dirty = True
+
+    def stats(self):
+        n = self.hits + self.misses
+        size = sum(map(len, self.entries.values()))
+        return {
+            "size": size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / n if n else 0.0,
+        }
+
+    def save(self):
+        with self.lock:
+            if not self.dirty or not self.path:
+                return
+            self._evict()
+            d = {
+                "tag": self.tag,
+                "entries": {k: list(v) for k, v in self.entries.items()},
+            }
+            self.dirty = False
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(d, f)
+        os.replace(tmp, self.path)
+
+
+def get_answer_cache():  # saved at exit
+    if "acache" not in _lazy:
+        with _lazy_lock:
+            if "acache" not in _lazy:
+                _lazy["acache"] = AnswerCache()
+                atexit.register(_lazy["acache"].save)
+    return _lazy["acache"]
+
+
+def answer(query, qvec, chunks, hits, index):  # the LLM call behind the answer cache
+    used, context = pack_context(qvec, hits, chunks, index)
+    cache = get_answer_cache()
+    ans = cache.get(qvec, chunks, used)
+    if ans is None:
+        ans = ask_llm(make_prompt(query, context))
+        cache.put(qvec, chunks, used, ans)
+    return ans
+
+
+def answer_stream(query, qvec, chunks, hits, index):  # cached answers come in one piece
+    used, context = pack_context(qvec, hits, chunks, index)
+    cache = get_answer_cache()
+    ans = cache.get(qvec, chunks, used)
+    if ans is not None:
+        yield ans
+        return
+    parts = []
+    for t in ask_llm_stream(make_prompt(query, context)):
+        parts.append(t)
+        yield t
+    cache.put(qvec, chunks, used, "".join(parts))
+
+
+# texts: for a LexicalIndex; ids: select_ids()
+def search_hits(qvecs, index, k=TOPK, texts=None, ids=None):
+    if ids is not None:
+        D, labels = search_subset(index, qvecs, k, ids)
+    else:
+        kw = (
+            {"texts": list(texts)}
+            if texts is not None and isinstance(index, LexicalIndex)
+            else {}
+        )
+        # D: squared distances, labels: chunk ids
+        D, labels = index.search(qvecs, k, **kw)
+    return [hits_of(d, i) for d, i in zip(D, labels)]
+
+
+def retrieve(query, index, k=TOPK, ids=None):
+    return search_hits(encode_queries([query]), index, k, [query], ids)[0]
+
+
+def query_rag(query, index, chunks, k=TOPK, ids=None):
+    qvec = encode_queries([query])
+    hits = search_hits(qvec, index, k, [query], ids)[0]
+    return answer(query, qvec[0], chunks, hits, index), hits
+
+
+# Streaming: retrieval runs eagerly and its hits are returned at once; the answer
+# is a generator of text deltas, so callers can show the page table before the
+# first token. query_rag stays the blocking form.
+
+
+def query_rag_stream(query, index, chunks, k=TOPK, ids=None):  # -> hits, token iterator
+    qvec = encode_queries([query])
+    hits = search_hits(qvec, index, k, [query], ids)[0]
+    return hits, answer_stream(query, qvec[0], chunks, hits, index)
+
+
+# Batch: one encode, one vectorised search, LLM calls fanned out to a bounded
+# thread pool. Returns [(answer, hits)] in query order, like query_rag per item.
+
+
+def query_rag_batch(
+    queries, index, chunks, k=TOPK, concurrency=LLM_CONCURRENCY, ids=None
+):
+    queries = list(queries)
+    if not queries:
+        return []
+    Q = encode_queries(queries)
+    hits = search_hits(Q, index, k, queries, ids)
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        answers = list(
+            pool.map(
+                lambda j: answer(queries[j], Q[j], chunks, hits[j], index),
+                range(len(queries)),
+            )
+        )
+    return list(zip(answers, hits))
 
 
 def show_page_table(chunks, metas, scores):
@@ -154,20 +2503,542 @@ def show_page_table(chunks, metas, scores):
         print(f"{r:>2}. idx={idx:>6}  L2^2={d:.4f}  {m['doc']}#p{m['page']}  '{snip}'")
 
 
-import sys
+# Recall@k vs latency of the approximate kinds against the exact index, on the live
+# vectors of a pagefile. Queries default to a sample of stored chunk vectors.
+
+
+def bench_index(X, manifest, k=TOPK, nq=200, queries=None, seed=0):
+    ids = live_ids(manifest)
+    V = live_vectors(X, ids)
+    if queries:
+        Q = encode(list(queries))
+    else:
+        Q = V[
+            np.random.default_rng(seed).choice(len(V), min(nq, len(V)), replace=False)
+        ]
+    _, truth = make_index(V, ids, "flat").search(Q, k)
+    settings = [("flat", None)]
+    settings += [("ivf", p) for p in (1, 2, 4, 8, 16, 32, 64)]
+    settings += [("hnsw", ef) for ef in (16, 32, 64, 128, 256)]
+    settings += [("sq8", None)] + [("ivfpq", p) for p in (4, 8, 16, 32, 64)]
+    built, rows = {}, []
+    print(f"# Index benchmark: {len(Q)} queries, k={k}, {len(V)} vectors")
+    print("# (compressed kinds re-ranked)")
+    head = ("kind", "param", "recall@k", "ms/query", "build_s", "B/vec")
+    print("{:<6} {:>5} {:>9} {:>9} {:>8} {:>6}".format(*head))
+    for kind, p in settings:
+        if kind not in built:
+            t = time.perf_counter()
+            built[kind] = (
+                searchable(make_index(V, ids, kind), X),
+                time.perf_counter() - t,
+            )
+        ix, build_s = built[kind]
+        tune_index(unwrap(ix), nprobe=p, ef_search=p)
+        t = time.perf_counter()
+        labels = np.vstack([ix.search(Q[i : i + 1], k)[1] for i in range(len(Q))])
+        ms = (time.perf_counter() - t) * 1000 / max(len(Q), 1)
+        recall = np.mean(
+            [
+                len((set(a) & set(b)) - {-1}) / max(1, (b >= 0).sum())
+                for a, b in zip(labels, truth)
+            ]
+        )
+        # * = too few vectors, fell back
+        label = kind if index_kind(ix) == kind else f"{kind}*"
+        row = (kind, p, float(recall), ms, build_s, vector_bytes(ix))
+        rows.append(row)
+        print(
+            "{:<6} {:>5} {:>9.3f} {:>9.3f} {:>8.2f} {:>6}".format(
+                label, p or "-", *row[2:]
+            )
+        )
+    return rows
+
+
+# Word vs token chunking on the first pages of a corpus: chunk count, word-pieces
+# lost to truncation at the model window, and chunking/encoding throughput.
+
+
+def bench_chunker(pdf_dir=PDF_DIR, max_pages=200):
+    pdfs = sorted(Path(pdf_dir).glob("*.pdf"))
+    pages = [pg for ps in load_texts_by_file(pdfs) for pg in ps or ()][:max_pages]
+    m = get_model()
+    limit, rows = m.max_seq_length, []
+    print(f"# Chunker benchmark: {len(pages)} pages, model window {limit} word-pieces")
+    head = "chunker chunks tok/chunk lost% chunk_s encode_s chunks/s tok/s".split()
+    print("{:<7} {:>7} {:>9} {:>6} {:>8} {:>8} {:>8} {:>8}".format(*head))
+    for name, split in (("words", chunk_text), ("tokens", chunk_tokens)):
+        t = time.perf_counter()
+        chunks = [c for text, _ in pages for c in split(text)]
+        chunk_s = time.perf_counter() - t
+        lens = np.asarray(
+            [len(ids) for ids in m.tokenizer(chunks, verbose=False)["input_ids"]] or [0]
+        )
+        lost = float(np.maximum(lens - limit, 0).sum() / max(lens.sum(), 1))
+        t = time.perf_counter()
+        encode(chunks)
+        enc_s = time.perf_counter() - t
+        kept = int(np.minimum(lens, limit).sum())
+        rows.append((name, len(chunks), float(lens.mean()), lost, chunk_s, enc_s))
+        rate, tok_rate = len(chunks) / max(enc_s, 1e-9), kept / max(enc_s, 1e-9)
+        print(
+            f"{name:<7} {len(chunks):>7} {lens.mean():>9.1f} {100 * lost:>6.1f}"
+            f" {chunk_s:>8.2f} {enc_s:>8.2f} {rate:>8.1f} {tok_rate:>8.0f}"
+        )
+    return rows
+
+
+import sys, argparse
+
+
+def current_pagefile(path=PAGE_FILE):  # the published snapshot, as is
+    pf = load_pagefile(path)
+    return (
+        searchable(pf["ix"], pf["X"], pf["lex"]),
+        pf["X"],
+        pf["chunks"],
+        pf["metas"],
+        pf["manifest"],
+    )
 
 
 def ensure_pagefile():
-    return update_pagefile(PDF_DIR, PAGE_FILE)
+    if not os.path.exists(PAGE_FILE) and os.path.isfile(LEGACY_PAGE_FILE):
+        convert_pagefile(LEGACY_PAGE_FILE, PAGE_FILE)
+    if not os.path.exists(PAGE_FILE):
+        return update_pagefile(PDF_DIR, PAGE_FILE)
+    if watcher_running(PAGE_FILE):  # fresh already: no PDF scan
+        return current_pagefile(PAGE_FILE)
+    try:
+        return update_pagefile(PDF_DIR, PAGE_FILE, wait=False)
+    except BlockingIOError:  # a writer is busy: query the snapshot it replaces
+        return current_pagefile(PAGE_FILE)
 
 
-if __name__ == "__main__":
-    query = (
-        " ".join(sys.argv[1:])
-        if len(sys.argv) > 1
-        else "How does HIPAA affect food delivery apps?"
+# Watch mode: a background loop stats PDF_DIR every WATCH_POLL_S (one scandir; no
+# hashing, no pagefile access) and, once a burst of changes has been quiet for
+# WATCH_DEBOUNCE_S, runs update_pagefile, which publishes a new snapshot. Servers
+# swap it in on their next poll. While a watcher holds path + ".watch", CLI
+# queries just load the current snapshot instead of re-checking every PDF.
+
+WATCH_POLL_S = float(os.getenv("RAG_WATCH_POLL", "2.0"))
+WATCH_DEBOUNCE_S = float(os.getenv("RAG_WATCH_DEBOUNCE", "5.0"))
+
+
+def scan_pdfs(pdf_dir=PDF_DIR):  # path -> (mtime_ns, size)
+    out = {}
+    with os.scandir(pdf_dir) as it:
+        for e in it:
+            if e.name.endswith(".pdf") and e.is_file():
+                st = e.stat()
+                out[os.path.join(pdf_dir, e.name)] = (st.st_mtime_ns, st.st_size)
+    return out
+
+
+def watcher_running(path=PAGE_FILE):
+    if fcntl is None or not os.path.exists(path + ".watch"):
+        return False
+    with open(path + ".watch", "a") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except OSError:
+            return True
+    return False
+
+
+class PdfWatcher:
+    def __init__(
+        self,
+        pdf_dir=PDF_DIR,
+        path=PAGE_FILE,
+        every=WATCH_POLL_S,
+        debounce=WATCH_DEBOUNCE_S,
+    ):
+        self.pdf_dir, self.path, self.every, self.debounce = (
+            pdf_dir,
+            path,
+            every,
+            debounce,
+        )
+        self.seen, self.updates = None, 0  # listing of the last update, updates run
+
+    def refresh(self, listing=None):
+        listing = scan_pdfs(self.pdf_dir) if listing is None else listing
+        try:
+            update_pagefile(self.pdf_dir, self.path)
+        except Exception as e:  # e.g. a PDF still being copied
+            print(f"warn: update of {self.path} failed: {e}")
+            return False
+        self.seen, self.updates = listing, self.updates + 1
+        return True
+
+    def run(self, stop):
+        with open(self.path + ".watch", "a") as f:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)  # held while watching
+                except OSError:
+                    raise RuntimeError(
+                        f"{self.path} is already being watched"
+                    ) from None
+            self.refresh()
+            # listing still settling, and when it last changed
+            pending, since = None, 0.0
+            while not stop.wait(self.every):
+                listing = scan_pdfs(self.pdf_dir)
+                if listing == self.seen:
+                    pending = None
+                elif listing != pending:
+                    pending, since = listing, time.monotonic()
+                elif time.monotonic() - since >= self.debounce:
+                    if self.refresh(listing):
+                        print(f"info: updated {self.path} ({len(listing)} PDFs)")
+                    pending = None  # on failure, retried once the listing settles again
+
+
+def watch(pdf_dir=PDF_DIR, path=PAGE_FILE):
+    every, quiet = WATCH_POLL_S, WATCH_DEBOUNCE_S
+    print(f"watching {pdf_dir} -> {path} (every {every}s, debounce {quiet}s)")
+    try:
+        PdfWatcher(pdf_dir, path).run(threading.Event())
+    except KeyboardInterrupt:
+        pass
+
+
+# Resident server: model, index and chunks load once; requests run on a bounded
+# thread pool. A poller notices a re-saved pagefile (new meta.json inode) and
+# swaps in the new maps with one reference assignment; requests already running
+# keep the snapshot they started with. With watch=True the server also runs a
+# PdfWatcher, so new PDFs reach it without any CLI run.
+#   POST /query   {"q": str, "k": int, "answer": bool, "doc": str | [str],
+#                  "pages": [a, b]} -> {"answer", "hits"}
+#   GET  /health  -> {"stamp", "chunks", "query_cache", "answer_cache"}
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+SERVE_ADDR = os.getenv("RAG_SERVE", "127.0.0.1:8765")
+SERVE_THREADS = int(os.getenv("RAG_SERVE_THREADS", "8"))
+SWAP_POLL_S = 2.0
+
+
+def pagefile_stamp(path=PAGE_FILE):
+    st = os.stat(os.path.join(path, "meta.json"))
+    return f"{st.st_ino}:{st.st_mtime_ns}"
+
+
+def table_row(chunks, metas, d, idx):
+    m = metas[idx]
+    return {
+        "idx": idx,
+        "l2": d,
+        "doc": m["doc"],
+        "page": m["page"],
+        "snippet": chunks[idx][:80],
+    }
+
+
+class RagService:
+    def __init__(self, path=PAGE_FILE):
+        self.path, self.state = path, None
+        self.swap()
+
+    def swap(self):  # -> True when a newer pagefile was loaded
+        try:
+            stamp = pagefile_stamp(self.path)
+            if self.state is not None and stamp == self.state["stamp"]:
+                return False
+            pf = load_pagefile(self.path)
+        except (OSError, ValueError) as e:  # mid-rename or half-written: try next poll
+            if self.state is None:
+                raise
+            print(f"warn: keeping pagefile {self.state['stamp']}: {e}")
+            return False
+        pf["ix"], pf["stamp"] = searchable(pf["ix"], pf["X"], pf.get("lex")), stamp
+        self.state = pf
+        return True
+
+    def poll(self, stop, every=SWAP_POLL_S):
+        while not stop.wait(every):
+            if self.swap():
+                print(f"info: swapped in pagefile {self.state['stamp']}")
+
+    def query(self, q, k=TOPK, with_answer=True, docs=None, pages=None):
+        pf = self.state  # one snapshot per request
+        ids = select_ids(pf["manifest"], pf["metas"], docs, pages)
+        qvec = encode_queries([q])
+        hits = search_hits(qvec, pf["ix"], k, [q], ids)[0]
+        out = {"hits": [table_row(pf["chunks"], pf["metas"], d, i) for d, i in hits]}
+        if with_answer:
+            out["answer"] = answer(q, qvec[0], pf["chunks"], hits, pf["ix"])
+        return out
+
+
+class RagHandler(BaseHTTPRequestHandler):
+    service = None
+
+    def _send(self, code, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != "/health":
+            return self._send(404, {"error": "not found"})
+        pf = self.service.state
+        body = {
+            "stamp": pf["stamp"],
+            "chunks": len(pf["chunks"]),
+            "query_cache": get_query_cache().stats(),
+            "answer_cache": get_answer_cache().stats(),
+        }
+        self._send(200, body)
+
+    def do_POST(self):
+        if self.path != "/query":
+            return self._send(404, {"error": "not found"})
+        try:
+            req = json.loads(
+                self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}"
+            )
+            q, k, with_answer = (
+                req["q"],
+                int(req.get("k", TOPK)),
+                bool(req.get("answer", True)),
+            )
+            pages = req.get("pages") and tuple(int(p) for p in req["pages"][:2])
+        except (ValueError, KeyError, TypeError):
+            return self._send(400, {"error": 'expected JSON body {"q": "..."}'})
+        try:
+            self._send(
+                200, self.service.query(q, k, with_answer, req.get("doc"), pages)
+            )
+        except Exception as e:
+            self._send(500, {"error": str(e)})
+
+
+class PooledHTTPServer(HTTPServer):  # HTTPServer that hands requests to a fixed pool
+    def __init__(self, addr, handler, threads=SERVE_THREADS):
+        super().__init__(addr, handler)
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._work, request, client_address)
+
+    def _work(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=True)
+
+
+def serve(addr=SERVE_ADDR, path=PAGE_FILE, threads=SERVE_THREADS, watch=False):
+    if not os.path.exists(path):
+        ensure_pagefile()
+    host, port = addr.rsplit(":", 1)
+    handler = type("Handler", (RagHandler,), {"service": RagService(path)})
+    httpd = PooledHTTPServer((host, int(port)), handler, threads)
+    stop = threading.Event()
+    threading.Thread(target=handler.service.poll, args=(stop,), daemon=True).start()
+    if watch:
+        threading.Thread(
+            target=PdfWatcher(PDF_DIR, path).run, args=(stop,), daemon=True
+        ).start()
+    print(f"serving {path} on http://{host}:{port} ({threads} threads)")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        httpd.server_close()
+
+
+# Cold start: a fresh interpreter imports rag, maps the pagefile and runs two
+# retrievals, reporting each step and whether torch/openai got imported.
+
+
+DEFAULT_QUERY = "How does HIPAA affect food delivery apps?"
+
+
+def bench_startup(query=DEFAULT_QUERY, path=PAGE_FILE):
+    import subprocess
+
+    code = f"""
+import json, sys, time
+t0 = time.perf_counter()
+sys.path.insert(0, {os.path.dirname(os.path.abspath(__file__))!r})
+import rag
+t1 = time.perf_counter()
+pf = rag.load_pagefile({path!r})
+ix = rag.searchable(pf["ix"], pf["X"], pf.get("lex"))
+t2 = time.perf_counter()
+rag.retrieve({query!r}, ix)
+t3 = time.perf_counter()
+rag.retrieve({query!r}, ix)
+t4 = time.perf_counter()
+print(json.dumps({{"import_s": t1 - t0, "load_s": t2 - t1, "first_query_s": t3 - t2,
+                  "warm_query_s": t4 - t3, "torch": "torch" in sys.modules,
+                  "openai": "openai" in sys.modules}}))
+"""
+    t = time.perf_counter()
+    out = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    r = json.loads(out.stdout.strip().splitlines()[-1])
+    r["process_s"] = time.perf_counter() - t
+    print("# Startup benchmark (fresh interpreter, retrieval only)")
+    for key, v in r.items():
+        print(f"{key:>14}: {v:.3f}" if isinstance(v, float) else f"{key:>14}: {v}")
+    return r
+
+
+def page_range(s):  # "12" or "3-10" -> (first, last), 1-based inclusive
+    a, _, b = s.partition("-")
+    try:
+        return int(a), int(b or a)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected PAGE or FIRST-LAST, got {s!r}")
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Ask a question over the PDF corpus.")
+    ap.add_argument("query", nargs="*")
+    ap.add_argument(
+        "--convert",
+        nargs="*",
+        metavar="PATH",
+        help="migrate a pickled pagefile: [SRC [DST]]",
+    )
+    ap.add_argument(
+        "--serve",
+        nargs="?",
+        const=SERVE_ADDR,
+        metavar="HOST:PORT",
+        help="run the resident query server",
     )
+    ap.add_argument(
+        "--watch", action="store_true", help="keep the pagefile updated as PDFs change"
+    )
+    ap.add_argument(
+        "--rollback",
+        type=int,
+        nargs="?",
+        const=0,
+        metavar="SNAPSHOT",
+        help="republish a kept snapshot (default: previous)",
+    )
+    ap.add_argument(
+        "--stream", action="store_true", help="print answer tokens as they arrive"
+    )
+    ap.add_argument(
+        "--retrieve", action="store_true", help="print the page table only; no LLM call"
+    )
+    ap.add_argument(
+        "--bench-startup",
+        action="store_true",
+        help="report import and first-query time",
+    )
+    ap.add_argument(
+        "--cache-stats", action="store_true", help="print query/answer cache hit rates"
+    )
+    ap.add_argument(
+        "--batch", metavar="FILE", help="answer every line of FILE as a question"
+    )
+    ap.add_argument(
+        "--bench-index",
+        type=int,
+        nargs="?",
+        const=200,
+        metavar="NQ",
+        help="recall@k vs latency report",
+    )
+    ap.add_argument(
+        "--bench-chunker",
+        type=int,
+        nargs="?",
+        const=200,
+        metavar="PAGES",
+        help="word vs token chunking report",
+    )
+    ap.add_argument(
+        "--doc",
+        action="append",
+        metavar="NAME",
+        help="search only this PDF (repeatable)",
+    )
+    ap.add_argument(
+        "--pages", type=page_range, metavar="A-B", help="search only these pages"
+    )
+    a = ap.parse_args(argv)
+    if a.convert is not None:
+        src = a.convert[0] if a.convert else LEGACY_PAGE_FILE
+        dst = a.convert[1] if len(a.convert) > 1 else PAGE_FILE
+        print("converted", src, "->", convert_pagefile(src, dst))
+        return
+    if a.rollback is not None:
+        print("published snapshot", rollback_pagefile(PAGE_FILE, a.rollback or None))
+        return
+    if a.serve:
+        return serve(a.serve, watch=a.watch)
+    if a.watch:
+        return watch()
+    if a.cache_stats:
+        print(
+            json.dumps(
+                {
+                    "query": get_query_cache().stats(),
+                    "answer": get_answer_cache().stats(),
+                }
+            )
+        )
+        return
+    if a.bench_chunker:
+        bench_chunker(PDF_DIR, a.bench_chunker)
+        return
     ix, X, chunks, metas, manifest = ensure_pagefile()
-    ans, scores = query_rag(query, ix, chunks, k=TOPK)
+    query = " ".join(a.query) or DEFAULT_QUERY
+    ids = select_ids(manifest, metas, a.doc, a.pages)
+    if a.bench_startup:
+        bench_startup(query)
+        return
+    if a.bench_index:
+        bench_index(X, manifest, k=TOPK, nq=a.bench_index)
+        return
+    if a.batch:
+        with open(a.batch) as f:
+            questions = [q.strip() for q in f if q.strip()]
+        for q, (ans, scores) in zip(
+            questions, query_rag_batch(questions, ix, chunks, k=TOPK, ids=ids)
+        ):
+            print(f"\n=== {q}")
+            show_page_table(chunks, metas, scores)
+            print("\n---\n", ans)
+        return
+    if a.retrieve:
+        show_page_table(chunks, metas, retrieve(query, ix, k=TOPK, ids=ids))
+        return
+    if a.stream:
+        scores, tokens = query_rag_stream(query, ix, chunks, k=TOPK, ids=ids)
+        show_page_table(chunks, metas, scores)
+        print("\n---\n", end=" ", flush=True)
+        for t in tokens:
+            print(t, end="", flush=True)
+        print()
+        return
+    ans, scores = query_rag(query, ix, chunks, k=TOPK, ids=ids)
     show_page_table(chunks, metas, scores)
     print("\n---\n", ans)
+
+
+if __name__ == "__main__":
+    main()
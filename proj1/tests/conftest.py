@@ -0,0 +1,63 @@
+import json
+import os
+import sys
+import types
+
+import pytest
+
+# Offline and in-process: hash embeddings, serial extraction without a pool
+os.environ["RAG_EMBED"] = "hash"
+os.environ["RAG_EXTRACT_TIMEOUT"] = "0"
+
+# proj1 and the PyPDF2 stub on the path (spawned workers inherit sys.path)
+here = os.path.dirname(__file__)
+sys.path.insert(0, os.path.abspath(os.path.join(here, "..")))
+sys.path.insert(0, os.path.abspath(os.path.join(here, "stubs")))
+
+import rag  # noqa: E402
+
+
+def page_text(doc, page, words=12):
+    """Distinct words per doc and page, short enough for one chunk."""
+    return f"{doc} page{page} " + " ".join(f"{doc}w{page}x{j}" for j in range(words))
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    """Each test runs in its own directory, with the query and answer caches off."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setitem(rag._lazy, "qcache", rag.QueryCache(path=None))
+    monkeypatch.setitem(rag._lazy, "acache", rag.AnswerCache(path=None))
+    return tmp_path
+
+
+@pytest.fixture
+def docs(workdir):
+    """A PDF directory; docs.write(name, pages) adds or replaces a document."""
+    d = workdir / "docs"
+    d.mkdir()
+
+    def write(name, pages):
+        p = d / name
+        p.write_text(json.dumps(pages))
+        return p
+
+    def make(name, n=3):
+        return write(name, [page_text(name[:-4], i) for i in range(n)])
+
+    return types.SimpleNamespace(dir=str(d), write=write, make=make)
+
+
+@pytest.fixture
+def encoded(monkeypatch):
+    """Texts that reach the embedding model, in call order."""
+    seen = []
+    real = rag.encode
+
+    def encode(texts):
+        texts = list(texts)
+        seen.extend(texts)
+        return real(texts)
+
+    monkeypatch.setattr(rag, "encode", encode)
+    return seen
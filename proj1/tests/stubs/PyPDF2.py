@@ -0,0 +1,24 @@
+"""PdfReader stand-in, importable by spawned extraction workers too."""
+
+import json
+import time
+
+
+class FakePage:
+    def __init__(self, text):
+        self.text = text
+
+    def extract_text(self):
+        return self.text
+
+
+class PdfReader:
+    """Reads a test "PDF": a JSON list of page texts, or {"hang": seconds}."""
+
+    def __init__(self, path):
+        with open(path) as f:
+            data = json.load(f)
+        if isinstance(data, dict):
+            time.sleep(data["hang"])
+            data = []
+        self.pages = [FakePage(t) for t in data]
@@ -0,0 +1,554 @@
+"""
+Regression tests for rag.py, on the offline hash backend.
+
+One section per feature: extraction, index kinds, caches, lexical and
+metadata filters, the streaming build, segments, snapshots and
+incremental updates.
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+import rag
+from conftest import page_text
+
+PF = "pf"
+
+
+def build(docs, **kw):
+    return rag.build_pagefile(docs.dir, PF, cache_path=None, **kw)
+
+
+def update(docs):
+    return rag.update_pagefile(docs.dir, PF, cache_path=None)
+
+
+def entry(manifest, name):
+    (e,) = [e for p, e in manifest.items() if os.path.basename(p) == name]
+    return e
+
+
+def all_hits(index, query, n):
+    return [i for _, i in rag.retrieve(query, index, k=n)]
+
+
+# =============================================================================
+# HASH BACKEND
+# =============================================================================
+
+
+def test_hash_backend_is_deterministic_and_tagged(docs, monkeypatch):
+    texts = ["alpha beta", "gamma", "alpha beta"]
+    X = rag.encode(texts)
+    assert X.shape == (3, rag.HASH_DIM) and np.array_equal(X, rag.encode(texts))
+    assert np.allclose(np.linalg.norm(X, axis=1), 1.0)
+    assert np.array_equal(X[0], X[2]) and not np.allclose(X[0], X[1])
+
+    docs.make("a.pdf")
+    build(docs)
+    assert rag.read_meta(PF)["encoder"] == f"hash:{rag.HASH_DIM}"
+    monkeypatch.setattr(rag, "EMBED_BACKEND", "torch")
+    with pytest.raises(ValueError, match="RAG_EMBED"):
+        rag.load_pagefile(PF)
+
+
+# =============================================================================
+# EXTRACTION
+# =============================================================================
+
+
+def test_pool_extraction_matches_serial(docs, monkeypatch):
+    monkeypatch.setattr(rag, "PAGES_PER_TASK", 2)  # b.pdf fans out in 3 ranges
+    pdfs = [docs.make("a.pdf", n=1), docs.make("b.pdf", n=5), docs.make("c.pdf")]
+    serial = list(rag.iter_texts_by_file(pdfs, 2, 0))
+    assert list(rag.iter_texts_by_file(pdfs, 2, 10.0)) == serial
+    assert [len(pages) for _, pages in serial] == [1, 5, 3]
+
+
+def count_reads(monkeypatch):  # -> names of the PDFs read, with a 1s timeout
+    monkeypatch.setattr(rag.iter_texts_by_file, "__defaults__", (1, 1.0))
+    real, read = rag.iter_texts_by_file, []
+
+    def iter_texts_by_file(pdfs, *args):
+        pdfs = [str(p) for p in pdfs]
+        read.extend(os.path.basename(p) for p in pdfs)
+        return real(pdfs, *args)
+
+    monkeypatch.setattr(rag, "iter_texts_by_file", iter_texts_by_file)
+    return read
+
+
+def test_timed_out_pdf_is_retried_only_on_a_new_sig(docs, monkeypatch):
+    read = count_reads(monkeypatch)
+    docs.make("a.pdf")
+    docs.write("slow.pdf", {"hang": 60})
+    docs.make("z.pdf")
+    manifest = build(docs)[4]
+    assert entry(manifest, "slow.pdf")["failed"] == "timeout"
+    assert not entry(manifest, "slow.pdf")["ids"] and entry(manifest, "z.pdf")["ids"]
+
+    read.clear()
+    update(docs)
+    assert read == []  # same sig: not read again
+    docs.write("slow.pdf", {"hang": 60, "rev": 2})
+    manifest = update(docs)[4]
+    assert read == ["slow.pdf"] and entry(manifest, "slow.pdf")["failed"]
+
+    docs.make("slow.pdf")  # readable now
+    manifest = update(docs)[4]
+    assert entry(manifest, "slow.pdf")["ids"] and "failed" not in entry(
+        manifest, "slow.pdf"
+    )
+
+
+def test_timed_out_revision_keeps_old_ids_but_not_renamed_ones(docs, monkeypatch):
+    read = count_reads(monkeypatch)
+    docs.make("a.pdf")
+    docs.make("b.pdf")
+    old = build(docs)[4]
+    os.rename(os.path.join(docs.dir, "a.pdf"), os.path.join(docs.dir, "a2.pdf"))
+    docs.write("a.pdf", {"hang": 60})
+    docs.write("b.pdf", {"hang": 60})
+    manifest = update(docs)[4]
+    assert entry(manifest, "a2.pdf")["ids"] == entry(old, "a.pdf")["ids"]
+    assert entry(manifest, "a.pdf")["ids"] == []  # the rename took a's ids
+    assert entry(manifest, "b.pdf")["ids"] == entry(old, "b.pdf")["ids"]
+    assert entry(manifest, "b.pdf")["failed"] == "timeout"
+    live = rag.live_ids(manifest).tolist()
+    assert len(live) == len(set(live)) == 6
+
+    read.clear()
+    update(docs)
+    assert read == []
+
+
+# =============================================================================
+# DELETIONS
+# =============================================================================
+
+
+def test_deleted_document_ids_never_come_back(docs):
+    for name in "abcdefgh":
+        docs.make(f"{name}.pdf")
+    manifest = build(docs)[4]
+    dead = set(rag.range_ids(entry(manifest, "d.pdf")["ids"]).tolist())
+    os.remove(os.path.join(docs.dir, "d.pdf"))
+    ix, _, chunks, _, manifest = update(docs)
+
+    assert not [p for p in manifest if os.path.basename(p) == "d.pdf"]
+    hits = all_hits(ix, page_text("d", 0), len(chunks))
+    assert hits and not set(hits) & dead
+    assert set(hits) <= set(rag.live_ids(manifest).tolist())
+
+
+# =============================================================================
+# INDEX BENCHMARK
+# =============================================================================
+
+
+def test_bench_index_recall_ignores_padding(capsys):
+    X = rag.encode([page_text("b", i) for i in range(5)])
+    manifest = {"b.pdf": {"ids": [[0, 5]]}}
+    rows = rag.bench_index(X, manifest, k=8, nq=5)
+    assert all(0.0 <= r[2] <= 1.0 for r in rows)
+    assert rows[0][2] == 1.0  # flat is exact
+
+
+# =============================================================================
+# RESIDENT SERVER
+# =============================================================================
+
+
+def test_service_swaps_in_new_pagefile_and_keeps_old_on_bad_one(docs):
+    docs.make("a.pdf")
+    build(docs)
+    svc = rag.RagService(PF)
+    assert not svc.swap()  # unchanged
+    first = svc.state
+
+    docs.make("b.pdf")
+    update(docs)
+    assert svc.swap() and svc.state is not first
+    hits = svc.query(page_text("b", 1), k=1, with_answer=False)["hits"]
+    assert hits[0]["doc"] == "b.pdf"
+
+    good = svc.state
+    with open(os.path.join(PF, "meta.json.tmp"), "w") as f:
+        f.write("{half")  # a half-written pagefile
+    os.replace(os.path.join(PF, "meta.json.tmp"), os.path.join(PF, "meta.json"))
+    assert not svc.swap() and svc.state is good
+    with pytest.raises(ValueError):
+        rag.RagService(PF)  # nothing to keep serving
+
+
+# =============================================================================
+# ANSWER CACHE
+# =============================================================================
+
+
+def test_answer_cache_ignores_hit_order():
+    cache = rag.AnswerCache(path=None)
+    chunks = ["one", "two", "three"]
+    q = np.ones(4, np.float32)
+    cache.put(q, chunks, [(0.1, 2), (0.2, 0)], "answer")
+    assert cache.get(q, chunks, [(0.1, 0), (0.3, 2)]) == "answer"
+    assert cache.get(q, ["one", "two", "changed"], [(0.1, 0), (0.3, 2)]) is None
+
+
+# =============================================================================
+# CONTEXT PACKING
+# =============================================================================
+
+
+def packing_case():  # 1 duplicates 0; 3 is less relevant than 2 but more novel
+    V = np.array([[1, 0, 0], [1, 0, 0], [0.94, 0.34, 0], [0.6, 0, 0.8]], np.float32)
+    V /= np.linalg.norm(V, axis=1, keepdims=True)
+    ix = rag.make_index(V, np.arange(4), "flat")
+    chunks = [f"chunk{i} " + "x" * 150 for i in range(4)]  # 40 tokens each
+    hits = [(0.1 * i, i) for i in range(4)]  # by relevance
+    return np.array([1, 0, 0.3], np.float32), hits, chunks, ix
+
+
+def test_pack_context_orders_by_mmr_and_drops_duplicates():
+    q, hits, chunks, ix = packing_case()
+    used, context = rag.pack_context(q, hits, chunks, ix, budget=1000, lam=0.7)
+    assert [i for _, i in used] == [0, 3, 2]
+    assert context == "\n\n".join(chunks[i] for i in (0, 3, 2))
+
+
+def test_pack_context_stays_within_budget():
+    q, hits, chunks, ix = packing_case()
+    used, context = rag.pack_context(q, hits, chunks, ix, budget=100, lam=0.7)
+    assert [i for _, i in used] == [0, 3, 2]  # the last one trimmed to fit
+    assert rag.count_tokens(context) <= 100
+    assert context.startswith(chunks[0]) and not context.endswith(chunks[2])
+    assert rag.pack_context(q, hits, chunks, ix, budget=0) == ([], "")
+
+
+# =============================================================================
+# LEXICAL SEARCH
+# =============================================================================
+
+
+@pytest.mark.parametrize("mode", ["auto", "filter"])
+def test_lexical_search_fills_up_to_k(mode):
+    chunks = ["w1 alpha beta", "w2 gamma delta", "hipaa 164.502 rule", "eps zeta"]
+    X = rag.encode(chunks)
+    ix = rag.make_index(X, np.arange(len(chunks)), "flat")
+    lix = rag.LexicalIndex(ix, X, rag.Lexicon.build(chunks), mode)
+    for query in ("hipaa 164.502", "w1 w2"):
+        hits = rag.search_hits(rag.encode([query]), lix, 3, [query])[0]
+        assert len(hits) == 3 and len({i for _, i in hits}) == 3
+        assert [d for d, _ in hits] == sorted(d for d, _ in hits)
+
+
+# =============================================================================
+# METADATA FILTERS
+# =============================================================================
+
+
+def test_page_filter_over_segments_and_renames(docs, monkeypatch):
+    for name in "ab":
+        docs.make(f"{name}.pdf", n=6)
+    build(docs)
+    os.rename(os.path.join(docs.dir, "a.pdf"), os.path.join(docs.dir, "a2.pdf"))
+    docs.make("c.pdf", n=6)
+    update(docs)
+    pf = rag.load_pagefile(PF)
+    metas = pf["metas"]
+
+    def no_dicts(*_):
+        raise AssertionError("meta dict built for a page filter")
+
+    monkeypatch.setattr(rag.MetaStore, "load", no_dicts)
+    ids = rag.select_ids(pf["manifest"], metas, pages=(2, 3))
+    monkeypatch.undo()
+    got = sorted((metas[i]["doc"], metas[i]["page"]) for i in ids)
+    assert got == [(d, p) for d in ("a2.pdf", "b.pdf", "c.pdf") for p in (2, 3)]
+    ids = rag.select_ids(pf["manifest"], metas, docs="a2.pdf", pages=(5, 9))
+    assert [metas[i]["page"] for i in ids] == [5, 6]
+
+
+def test_filters_on_pre_id_manifest_read_metas():
+    metas = [
+        {"doc": d, "page": p, "chunk": 0} for d in ("a.pdf", "b.pdf") for p in (1, 2, 3)
+    ]
+    manifest = {"docs/a.pdf": [1, 2], "docs/b.pdf": [3, 4]}  # {path: sig}
+    ids = rag.select_ids(manifest, metas, docs="b.pdf", pages=(2, 3))
+    assert ids.tolist() == [4, 5]
+    assert rag.select_ids(manifest, metas, pages=(1, 1)).tolist() == [0, 3]
+
+
+# =============================================================================
+# STREAMING BUILD
+# =============================================================================
+
+
+def test_build_lexicon_matches_in_memory_one(docs, workdir):
+    for name in "abcde":
+        docs.make(f"{name}.pdf")
+    build(docs, batch=4)  # several spilled postings runs
+    pf = rag.load_pagefile(PF)
+    seg = os.path.join(PF, pf["segments"][0]["name"])
+    assert not [f for f in os.listdir(seg) if f.startswith("lexrun-")]
+    ref = workdir / "ref"
+    ref.mkdir()
+    rag.Lexicon.build(list(pf["chunks"])).save(str(ref))
+    for f in ("terms.bin", "terms.off", "postings.off", "postings.ids", "postings.tf"):
+        with open(os.path.join(seg, f), "rb") as a, open(ref / f, "rb") as b:
+            assert a.read() == b.read(), f
+
+
+# =============================================================================
+# MULTI-PROCESS EMBEDDING
+# =============================================================================
+
+
+def test_encoder_pool_matches_in_process_encode():
+    texts = [page_text(f"t{i % 7}", i, words=i % 30 + 1) for i in range(200)]
+    with rag.EncoderPool(2) as enc:
+        X = enc(texts)
+        assert enc.pool is not None
+    assert np.allclose(X, rag.encode(texts), atol=1e-6)
+
+
+# =============================================================================
+# SEGMENTS AND THE EMBEDDING CACHE
+# =============================================================================
+
+
+def test_merge_smallest_preserves_ids(docs):
+    docs.make("a.pdf")
+    build(docs)
+    for name in "bcd":
+        docs.make(f"{name}.pdf")
+        update(docs)
+    os.remove(os.path.join(docs.dir, "b.pdf"))
+    update(docs)
+    pf = rag.load_pagefile(PF)
+    assert len(pf["segments"]) == 4
+    live = rag.live_ids(pf["manifest"])
+    texts = [pf["chunks"][i] for i in live]
+    X = rag.live_vectors(pf["X"], live)
+
+    rag.compact_segments(PF, 1)
+    pf = rag.load_pagefile(PF)
+    assert len(pf["segments"]) == 1
+    assert np.array_equal(rag.live_ids(pf["manifest"]), live)
+    assert [pf["chunks"][i] for i in live] == texts
+    assert np.array_equal(rag.live_vectors(pf["X"], live), X)
+    ix = rag.searchable(pf["ix"], pf["X"], pf["lex"])
+    hits = all_hits(ix, "b page1", len(pf["chunks"]))
+    assert hits and set(hits) <= set(live.tolist())
+
+
+def test_compact_pagefile_streams_live_rows_renumbered(docs, workdir):
+    for name in "abc":
+        docs.make(f"{name}.pdf")
+    build(docs)
+    docs.make("d.pdf")
+    os.rename(os.path.join(docs.dir, "a.pdf"), os.path.join(docs.dir, "a2.pdf"))
+    os.remove(os.path.join(docs.dir, "b.pdf"))
+    update(docs)
+    pf = rag.load_pagefile(PF)
+    live = rag.live_ids(pf["manifest"])
+    texts = [pf["chunks"][i] for i in live]
+    names = [pf["metas"][i]["doc"] for i in live]
+    X = rag.live_vectors(pf["X"], live)
+
+    rag.compact_pagefile(PF, batch=2)  # several slices and spilled postings runs
+    pf = rag.load_pagefile(PF)
+    n = len(live)
+    assert len(pf["segments"]) == 1 and len(pf["chunks"]) == n
+    assert rag.live_ids(pf["manifest"]).tolist() == list(range(n))
+    assert list(pf["chunks"]) == texts
+    assert [m["doc"] for m in pf["metas"]] == names and "a2.pdf" in names
+    assert np.array_equal(rag.live_vectors(pf["X"], np.arange(n)), X)
+    seg = os.path.join(PF, pf["segments"][0]["name"])
+    ref = workdir / "ref"
+    ref.mkdir()
+    rag.Lexicon.build(texts).save(str(ref))
+    for f in ("terms.bin", "postings.ids", "postings.tf"):
+        with open(os.path.join(seg, f), "rb") as a, open(ref / f, "rb") as b:
+            assert a.read() == b.read(), f
+
+
+def fail(texts):
+    raise AssertionError(f"re-encoded {list(texts)}")
+
+
+def test_embedding_cache_reload_and_prune(workdir, monkeypatch):
+    path = str(workdir / "emb.cache")
+    cache = rag.EmbeddingCache(path, model_name="m", encoder=rag.encode)
+    X = cache.encode(["x", "y", "x", "z"])
+    assert np.array_equal(X[0], X[2]) and len(cache) == 3
+
+    cache = rag.EmbeddingCache(path, model_name="m", encoder=fail)
+    assert np.array_equal(cache.encode(["z", "x"]), X[[3, 0]])
+
+    monkeypatch.setattr(rag, "EMB_CACHE_MAX", 1)
+    cache.save(live=["x", "z"])
+    cache = rag.EmbeddingCache(path, model_name="m", encoder=fail)
+    assert len(cache) == 2
+    assert np.array_equal(cache.encode(["x", "z"]), X[[0, 3]])
+    assert list(cache.find([rag.text_key("y")])) == [-1]
+
+    other = rag.EmbeddingCache(path, model_name="other", encoder=rag.encode)
+    assert len(other) == 0  # vectors of another model are not reused
+
+
+# =============================================================================
+# SNAPSHOTS
+# =============================================================================
+
+
+def test_rollback_pagefile_restores_previous_snapshot(docs):
+    docs.make("a.pdf")
+    first = build(docs)[4]
+    docs.make("b.pdf")
+    update(docs)
+    assert len(rag.load_pagefile(PF)["manifest"]) == 2
+
+    rag.rollback_pagefile(PF)
+    pf = rag.load_pagefile(PF)
+    assert pf["manifest"] == first
+    ix = rag.searchable(pf["ix"], pf["X"], pf["lex"])
+    assert set(all_hits(ix, "b page0", 10)) <= set(rag.live_ids(first).tolist())
+    with pytest.raises(ValueError):
+        rag.rollback_pagefile(PF, snapshot=999)
+
+
+# =============================================================================
+# DIRECTORY WATCHER
+# =============================================================================
+
+
+def run_watcher(docs, monkeypatch, steps, fail_at=()):
+    # polls once per step on a fake clock (every=1s, debounce=3s); -> update times
+    clock, times = [0.0], []
+
+    def update_pagefile(pdf_dir, path):
+        times.append(clock[0])
+        if clock[0] in fail_at:
+            raise OSError("still copying")
+
+    class Stop:  # each wait runs the next step, then the watcher polls
+        def wait(self, every):
+            clock[0] += every
+            step = next(steps, None)
+            if step is None:
+                return True
+            step()
+            return False
+
+    monkeypatch.setattr(rag.time, "monotonic", lambda: clock[0])
+    monkeypatch.setattr(rag, "update_pagefile", update_pagefile)
+    steps = iter(steps)
+    w = rag.PdfWatcher(docs.dir, PF, every=1, debounce=3)
+    w.run(Stop())
+    return times, w.updates
+
+
+def idle():
+    pass
+
+
+def test_watcher_waits_for_listing_to_settle(docs, monkeypatch):
+    steps = [
+        lambda: docs.write("a.pdf", ["half"]),
+        lambda: docs.write("a.pdf", ["half", "copied"]),  # restarts the debounce
+        *[idle] * 4,
+    ]
+    times, updates = run_watcher(docs, monkeypatch, steps)
+    assert times == [0, 5] and updates == 2
+
+
+def test_watcher_retries_failed_update_once_settled_again(docs, monkeypatch):
+    steps = [lambda: docs.make("a.pdf"), *[idle] * 8]
+    times, updates = run_watcher(docs, monkeypatch, steps, fail_at={4})
+    assert times == [0, 4, 8] and updates == 2  # not re-run on every poll
+
+
+# =============================================================================
+# CHANGE DETECTION
+# =============================================================================
+
+
+def test_touch_and_rename_keep_ids(docs, encoded):
+    for name in "ab":
+        docs.make(f"{name}.pdf")
+    manifest = build(docs)[4]
+    before = {n: entry(manifest, f"{n}.pdf") for n in "ab"}
+    encoded.clear()
+
+    a = os.path.join(docs.dir, "a.pdf")
+    st = os.stat(a)
+    os.utime(a, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))  # touch
+    os.rename(os.path.join(docs.dir, "b.pdf"), os.path.join(docs.dir, "b2.pdf"))
+    _, _, _, metas, manifest = update(docs)
+
+    assert entry(manifest, "a.pdf")["ids"] == before["a"]["ids"]
+    assert entry(manifest, "b2.pdf")["ids"] == before["b"]["ids"]
+    assert not [p for p in manifest if os.path.basename(p) == "b.pdf"]
+    assert metas[before["b"]["ids"][0][0]]["doc"] == "b2.pdf"
+    assert encoded == []
+
+
+def test_unchanged_update_encodes_nothing(docs, encoded):
+    docs.make("a.pdf")
+    manifest = build(docs)[4]
+    encoded.clear()
+    assert update(docs)[4] == manifest
+    assert encoded == []
+
+
+# =============================================================================
+# PAGE-LEVEL UPDATES
+# =============================================================================
+
+
+def test_page_edit_reencodes_only_that_page(docs, encoded):
+    for name in "abc":
+        docs.make(f"{name}.pdf")
+    old = entry(build(docs)[4], "c.pdf")["pages"]
+    encoded.clear()
+
+    pages = [page_text("c", i) for i in range(3)]
+    pages[1] = "c edited page " + " ".join(f"new{j}" for j in range(12))
+    docs.write("c.pdf", pages)
+    ix, _, chunks, _, manifest = update(docs)
+
+    new = entry(manifest, "c.pdf")["pages"]
+    assert [new[0], new[2]] == [old[0], old[2]]
+    assert new[1][2] >= len(chunks) - 1  # the edited page got fresh ids
+    assert encoded == [chunks[new[1][2]]] and encoded[0].startswith("c edited")
+    hits = all_hits(ix, page_text("c", 1), len(chunks))
+    assert hits and old[1][2] not in hits
+    assert set(hits) <= set(rag.live_ids(manifest).tolist())
+
+
+def test_new_revision_under_a_renamed_name_gets_its_own_ids(docs, monkeypatch):
+    docs.make("a.pdf", n=4)
+    docs.make("b.pdf")
+    build(docs)
+    os.rename(os.path.join(docs.dir, "a.pdf"), os.path.join(docs.dir, "a_v1.pdf"))
+    revised = [page_text("a", i) for i in range(3)] + ["a revised last page"]
+    docs.write("a.pdf", revised)
+    expected = {"a_v1.pdf": [page_text("a", i) for i in range(4)], "a.pdf": revised}
+
+    def check(chunks, metas, manifest):
+        live = rag.live_ids(manifest).tolist()
+        assert len(live) == len(set(live))
+        for name, texts in expected.items():
+            for pg, _, a, b in entry(manifest, name)["pages"]:
+                assert b - a == 1 and metas[a]["doc"] == name
+                assert chunks[a] == texts[pg - 1]
+
+    check(*update(docs)[2:])
+    os.remove(os.path.join(docs.dir, "b.pdf"))
+    monkeypatch.setattr(rag, "COMPACT_DEAD_FRACTION", 0.0)  # compact on this update
+    _, _, chunks, metas, manifest = update(docs)
+    assert len(chunks) == 8 and rag.live_ids(manifest).tolist() == list(range(8))
+    check(chunks, metas, manifest)